@@ -5,6 +5,8 @@ from distutils.core import Extension
 entry_points = """
 [console_scripts]
 snapshot-in-time = zc.FileStorage.snapshotintime:main
+pack-estimate = zc.FileStorage.estimate:main
+scrub-checksums = zc.FileStorage.checksums:main
 """
 
 tests_requirements = [
@@ -15,30 +15,107 @@
 from __future__ import absolute_import
 
 import binascii
+import collections
+import errno
+import functools
+import hashlib
+import heapq
+import io
 import logging
+import mmap
+import multiprocessing
 import os
+import select
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 from ZODB.FileStorage.format import FileStorageFormatter, CorruptedDataError
 from ZODB.utils import p64, u64, z64
-from ZODB.FileStorage.format import TRANS_HDR_LEN
+from ZODB.FileStorage.format import DataHeader, DATA_HDR_LEN, TRANS_HDR_LEN
+from ZODB.FileStorage.format import DataHeaderFromString, TxnHeaderFromString
+from ZODB.FileStorage.FileStorage import FileStorageQuotaError
 from zodbpickle import pickle
 
 import ZODB.FileStorage
 import ZODB.FileStorage.fspack
 import ZODB.fsIndex
+import ZODB.serialize
 import ZODB.TimeStamp
+import ZODB.utils
 
 
 GIG = 1 << 30
 
-
-def Packer(sleep=0, transform=None, untransform=None):
-    def packer(storage, referencesf, stop, gc):
-        return FileStoragePacker(storage, stop, sleep, transform, untransform).pack()
-
+progress_prefix = b"zc.FileStorage progress "
+
+
+def Packer(
+    sleep=0,
+    transform=None,
+    untransform=None,
+    worker=False,
+    report=None,
+    garbage=None,
+    dedup=None,
+    compress=None,
+    checksums=False,
+    verify=False,
+    checks="full",
+    pack_dir=None,
+    preallocate=False,
+    map_input=False,
+    copy_processes=None,
+    archive=None,
+    tids=False,
+    time_budget=None,
+    byte_budget=None,
+    scheduler=None,
+    slots=1,
+    rate=None,
+    priority=0,
+    stream=None,
+    warmup=None,
+    warmup_oids=None,
+):
+    def packer(storage, referencesf, stop, gc, handle=None):
+        return FileStoragePacker(
+            storage,
+            stop,
+            sleep,
+            transform,
+            untransform,
+            worker,
+            handle=handle,
+            report=report,
+            garbage=garbage,
+            dedup=dedup,
+            compress=compress,
+            checksums=checksums,
+            verify=verify,
+            checks=checks,
+            pack_dir=pack_dir,
+            preallocate=preallocate,
+            map_input=map_input,
+            copy_processes=copy_processes,
+            archive=archive,
+            tids=tids,
+            time_budget=time_budget,
+            byte_budget=byte_budget,
+            scheduler=scheduler,
+            slots=slots,
+            rate=rate,
+            priority=priority,
+            stream=stream,
+            warmup=warmup,
+            warmup_oids=warmup_oids,
+        ).pack()
+
+    # start_pack passes its handle to packers made here.
+    packer.takes_handle = True
     return packer
 
 
@@ -49,13 +126,212 @@ packer4 = Packer(3)
 packer8 = Packer(4)
 
 
+class PackCancelled(Exception):
+    """A pack was cancelled
+    """
+
+
+class PackHandle(object):
+    """A pack running in the background
+
+    The status is one of "starting", "running", "paused",
+    "cancelling", "finishing", "done", "cancelled" or "failed".  The
+    progress is None or a tuple giving the pack phase, the position
+    reached and the position the phase ends at.
+
+    Pause, resume and cancel requests are honoured by the pack
+    subprocess between transactions.  Once the subprocess is done and
+    the pack is finishing, they're ignored.
+    """
+
+    status = "starting"
+    progress = error = None
+
+    def __init__(self, paused=False):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._send = None
+        self._pending = []
+        if paused:
+            self.pause()
+
+    def _attach(self, send, start=None):
+        # Called by the packer with a function for sending commands to
+        # the pack subprocess.  If `start` is given, it's called with
+        # any commands given so far, rather than sending them.
+        with self._lock:
+            commands = b"".join(self._pending)
+            del self._pending[:]
+            if start is not None:
+                start(commands)
+            elif commands:
+                send(commands)
+            self._send = send
+            if self.status == "starting":
+                self.status = "running"
+
+    def _detach(self):
+        with self._lock:
+            self._send = None
+            if self.status in ("starting", "running", "paused"):
+                self.status = "finishing"
+
+    def _command(self, command, status):
+        with self._lock:
+            if self._done.is_set() or self.status == "finishing":
+                return
+            if status != "cancelling" and self.status == "cancelling":
+                return
+            self.status = status
+            if self._send is None:
+                self._pending.append(command)
+            else:
+                self._send(command)
+
+    def pause(self):
+        self._command(b"p", "paused")
+
+    def resume(self):
+        self._command(b"r", "running")
+
+    def cancel(self):
+        self._command(b"c", "cancelling")
+
+    def wait(self, timeout=None):
+        """Wait for the pack to finish, returning whether it has
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+
+def start_pack(storage, t=None, referencesf=None, paused=False):
+    """Pack a file storage in the background, returning a PackHandle
+
+    The storage's packer must be created by ``Packer``, otherwise the
+    pack can't be paused or cancelled and there's no progress.  If
+    `paused` is true, the pack is paused before it reads any data.
+    """
+    if t is None:
+        t = time.time()
+    if referencesf is None:
+        referencesf = ZODB.serialize.referencesf
+    handle = PackHandle(paused)
+
+    def run():
+        packer = storage.packer
+        if getattr(packer, "takes_handle", False):
+            # The storage calls its packer, so we give it one bound to
+            # the handle, for this pack only.
+            storage.packer = functools.partial(packer, handle=handle)
+        try:
+            storage.pack(t, referencesf)
+        except PackCancelled:
+            handle.status = "cancelled"
+        except Exception as v:
+            logging.getLogger(__name__).exception("packing %s", storage)
+            handle.error = v
+            handle.status = "failed"
+        else:
+            handle.status = "done"
+        finally:
+            if storage.packer is not packer:
+                storage.packer = packer
+            handle._done.set()
+
+    thread = threading.Thread(target=run, name="pack %s" % storage)
+    thread.setDaemon(True)
+    thread.start()
+    return handle
+
+
+class PackControl(object):
+    """Honour pause, resume and cancel commands between transactions
+
+    Commands are single bytes read from the pipe `fd`: ``p`` to pause,
+    ``r`` to resume and ``c`` to cancel.  The pipe is polled at every
+    check and read until resumed while paused.  If `report` is given,
+    it's called with the phase, position and end position as each
+    phase starts and then after every percent or so of progress.
+    """
+
+    paused = cancelled = False
+
+    def __init__(self, fd, report=None):
+        self.fd = fd
+        self.report = report
+        self._reported = None, 0
+
+    def _read(self, block=False):
+        # Read commands, waiting for one if `block` is true.
+        while self.fd is not None:
+            if not block:
+                try:
+                    if not select.select([self.fd], (), (), 0)[0]:
+                        break
+                except (select.error, ValueError):
+                    # Not a pollable pipe (Windows), so we can't be
+                    # controlled.
+                    self.fd = None
+                    break
+            block = False
+            command = os.read(self.fd, 1)
+            if command == b"p":
+                self.paused = True
+            elif command == b"r":
+                self.paused = False
+            elif command == b"c":
+                self.cancelled = True
+            elif not command:
+                # Whoever controlled us is gone. Don't stay paused.
+                self.paused = False
+                self.fd = None
+
+    def check(self, phase, pos, end):
+        self._read()
+        if self.paused and not self.cancelled:
+            logging.info("paused at %s", pos)
+            while self.paused and not self.cancelled:
+                self._read(True)
+            logging.info("resumed")
+        if self.cancelled:
+            logging.info("cancelled at %s", pos)
+            raise PackCancelled(phase, pos)
+
+        if self.report is not None:
+            last_phase, last_pos = self._reported
+            if phase != last_phase or pos - last_pos >= end // 100:
+                self._reported = phase, pos
+                self.report(phase, pos, end)
+
+
+def print_progress(phase, pos, end):
+    # Report progress to the parent process, which reads our output.
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    out.write(progress_prefix + ("%s %s %s\n" % (pos, end, phase)).encode())
+    out.flush()
+
+
 class FileStoragePacker(FileStorageFormatter):
-    def __init__(self, storage, stop, sleep=0, transform=None, untransform=None):
+    def __init__(
+        self,
+        storage,
+        stop,
+        sleep=0,
+        transform=None,
+        untransform=None,
+        worker=False,
+        handle=None,
+        **options
+    ):
         self.storage = storage
         self._name = path = storage._file.name
         self.sleep = sleep
         self.transform_option = transform
         self.untransform_option = untransform
+        self.worker = worker
+        self.handle = handle
+        # Additional PackProcess options
+        self.options = options
 
         # We open our own handle on the storage so that much of pack can
         # proceed in parallel.  It's important to close this file at every
@@ -84,7 +360,128 @@ class FileStoragePacker(FileStorageFormatter):
         self.ltid = z64
 
     def pack(self):
+        for name in "error", "log", "warmup":
+            name = self._name + ".pack" + name
+            if os.path.exists(name):
+                os.remove(name)
+
+        if self.worker:
+            import zc.FileStorage.worker
+
+            result = zc.FileStorage.worker.pack(
+                handle=self.handle,
+                path=self._name,
+                stop=self._stop,
+                size=self.file_end,
+                blob_dir=self.storage.blob_dir,
+                sleep=self.sleep,
+                transform=self.transform_option,
+                untransform=self.untransform_option,
+                options=self.options,
+            )
+        else:
+            result = self.runPackScript()
+
+        if result is None:
+            return  # already packed or pack didn't benefit
+
+        index, opos = result
+        checksums_path = self._name + ".pack.checksums"
+        if self.options.get("checksums"):
+            import zc.FileStorage.checksums
+
+            self.checksums = zc.FileStorage.checksums.ChecksumWriter(
+                checksums_path, append=True
+            )
+        tids_path = self._name + ".pack.tids"
+        if self.options.get("tids"):
+            import zc.FileStorage.tids
+
+            self.tids = zc.FileStorage.tids.TidWriter(tids_path, append=True)
+        warmup_path = self._name + ".packwarmup"
+        warmup_positions = None
+        if os.path.exists(warmup_path):
+            import zc.FileStorage.warmup
+
+            # The pack subprocess chose the records to warm.
+            warmup_positions = zc.FileStorage.warmup.load_positions(warmup_path)
+            os.remove(warmup_path)
+        with open(self._name + ".pack", "r+b") as output:
+            output.seek(0, 2)
+            assert output.tell() == opos
+            if self.options.get("stream"):
+                import zc.FileStorage.stream
+
+                # Continue the stream the pack subprocess started.
+                self.streamer = zc.FileStorage.stream.Streamer(
+                    output, self.options["stream"], opos
+                )
+            try:
+                self.copyRest(self.file_end, output, index)
+            except Exception:
+                self.closeStreamer(abort=True)
+                raise
+
+            # OK, we've copied everything. Now we need to wrap things up.
+            pos = output.tell()
+
+        self.logCopyStats(logging.getLogger(__name__).log)
 
+        if self.options.get("verify"):
+            import zc.FileStorage.verify
+
+            try:
+                zc.FileStorage.verify.verify_tail(self._name + ".pack", index, opos, pos)
+            except Exception:
+                # The storage only releases the commit lock if we succeed.
+                self._commit_lock_release()
+                self.locked = 0
+                self.closeStreamer(abort=True)
+                for writer in self.checksums, self.tids:
+                    if writer is not None:
+                        writer.close()
+                remove_output(self._name + ".pack")
+                raise
+
+        # Checksums and transaction positions describing the storage's
+        # file are stale once the packed file replaces it.
+        sidecars = {".checksums": None, ".tids": None}
+        if self.checksums is not None:
+            self.checksums.close()
+            sidecars[".checksums"] = checksums_path
+
+        if self.tids is not None:
+            self.tids.close()
+            sidecars[".tids"] = tids_path
+
+        # We hold the commit lock, so we leave the rest of the stream
+        # to be sent in the background.
+        self.closeStreamer(end=pos, wait=False)
+
+        if warmup_positions is not None:
+            # The packed file is about to replace the storage's, cold.
+            zc.FileStorage.warmup.start(self._name + ".pack", warmup_positions)
+
+        self.moveSidecars(sidecars)
+        return pos, index
+
+    def moveSidecars(self, sidecars):
+        # Move the packed file's sidecar files, given by suffix, into
+        # place, removing those that don't have packed versions.  The
+        # storage replaces its file with the packed file after we
+        # return.  Until it does, or if it fails to, readers find that
+        # the sidecars don't match the storage's file and ignore them.
+        name = self._name
+        for suffix, path in sorted(sidecars.items()):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+            if path is not None:
+                os.rename(path, name + suffix)
+
+    def runPackScript(self):
+        # Run PackProcess in a fresh Python process, returning the
+        # index and position it reached, or None if there was nothing
+        # to pack.
         script = self._name + ".packscript"
         with open(script, "w") as fd:
             fd.write(
@@ -98,12 +495,9 @@ class FileStoragePacker(FileStorageFormatter):
                     sleep=self.sleep,
                     transform=self.transform_option,
                     untransform=self.untransform_option,
+                    options=self.options,
                 )
             )
-        for name in "error", "log":
-            name = self._name + ".pack" + name
-            if os.path.exists(name):
-                os.remove(name)
         proc = subprocess.Popen(
             (sys.executable, script),
             stdin=subprocess.PIPE,
@@ -112,13 +506,35 @@ class FileStoragePacker(FileStorageFormatter):
             close_fds=True,
         )
 
-        proc.stdin.close()
-        out = proc.stdout.read()
+        # The subprocess reads pause, resume and cancel commands from
+        # its standard input and reports progress on its output.
+        handle = self.handle
+        if handle is not None:
+            handle._attach(_sender(proc.stdin))
+        out = []
+        try:
+            for line in iter(proc.stdout.readline, b""):
+                if line.startswith(progress_prefix):
+                    if handle is not None:
+                        pos, end, phase = (
+                            line[len(progress_prefix) :].decode().strip().split(" ", 2)
+                        )
+                        handle.progress = phase, int(pos), int(end)
+                else:
+                    out.append(line)
+        finally:
+            if handle is not None:
+                handle._detach()
+            proc.stdin.close()
+
+        out = b"".join(out)
         if proc.wait():
             if os.path.exists(self._name + ".packerror"):
                 with open(self._name + ".packerror", "rb") as fd:
                     v = pickle.Unpickler(fd).load()
                 os.remove(self._name + ".packerror")
+                if isinstance(v, PackCancelled):
+                    os.remove(script)
                 raise v
             raise RuntimeError(
                 "The Pack subprocess failed\n" + "-" * 60 + out + "-" * 60 + "\n"
@@ -126,74 +542,78 @@ class FileStoragePacker(FileStorageFormatter):
 
         packindex_path = self._name + ".packindex"
         if not os.path.exists(packindex_path):
-            return  # already packed or pack didn't benefit
+            return None
 
         with open(packindex_path, "rb") as fd:
-            index, opos = pickle.Unpickler(fd).load()
+            result = pickle.Unpickler(fd).load()
         os.remove(packindex_path)
         os.remove(self._name + ".packscript")
-
-        with open(self._name + ".pack", "r+b") as output:
-            output.seek(0, 2)
-            assert output.tell() == opos
-            self.copyRest(self.file_end, output, index)
-
-            # OK, we've copied everything. Now we need to wrap things up.
-            pos = output.tell()
-
-        return pos, index
+        return result
 
     def copyRest(self, input_pos, output, index):
         # Copy data records written since packing started.
 
+        if self.handle is not None:
+            self.handle.progress = "copy rest", input_pos, None
         self._commit_lock_acquire()
         self.locked = 1
-        # Re-open the file in unbuffered mode.
-
-        # The main thread may write new transactions to the file,
-        # which creates the possibility that we will read a status
-        # 'c' transaction into the pack thread's stdio buffer even
-        # though we're acquiring the commit lock.  Transactions
-        # can still be in progress throughout much of packing, and
-        # are written to the same physical file but via a distinct
-        # Python file object.  The code used to leave off the
-        # trailing 0 argument, and then on every platform except
-        # native Windows it was observed that we could read stale
-        # data from the tail end of the file.
-        self._file = open(self._name, "rb", 0)
+
+        # The main thread may write new transactions to the file
+        # while we copy, via a distinct Python file object.  Reading
+        # through a stdio buffer, we could read the tail of a
+        # transaction still being written.  The code used to read
+        # unbuffered, at the cost of a system call for every read.
+        # Instead, we only read committed transactions, up to the
+        # storage's position, which we get while holding the commit
+        # lock, so anything we buffer is final.
+        self._file = CommittedReader(self._name, self.storage._pos)
         try:
-            try:
-                while 1:
-                    # The call below will raise CorruptedDataError at EOF.
-                    input_pos = self._copyNewTrans(
-                        input_pos,
-                        output,
-                        index,
-                        self._commit_lock_acquire,
-                        self._commit_lock_release,
-                    )
-            except CorruptedDataError as err:
-                # The last call to copyOne() will raise
-                # CorruptedDataError, because it will attempt to read past
-                # the end of the file.  Double-check that the exception
-                # occurred for this reason.
-                self._file.seek(0, 2)
-                endpos = self._file.tell()
-                if endpos != err.pos:
-                    raise
+            while input_pos < self._file.end:
+                input_pos = self._copyNewTrans(
+                    input_pos,
+                    output,
+                    index,
+                    self._commit_lock_acquire,
+                    self._commit_lock_release,
+                )
+                if self.streamer is not None:
+                    self.streamer.written(output.tell())
+                # We have the commit lock again, so catch up with
+                # transactions committed while we were copying.
+                self._file.end = self.storage._pos
         finally:
             self._file.close()
 
     transform = None
+    dedup = None
+    backpointers = None
+    checksums = None
+    tids = None
+    budget = None
+    streamer = None
+
+    def closeStreamer(self, pos=None, end=None, abort=False, wait=True):
+        streamer = self.streamer
+        if streamer is not None:
+            streamer.close(pos, end, abort, wait)
+            self.streamer = None
+
+    # The records and bytes of the largest transaction copied by
+    # _copyNewTrans and the number of transactions whose indexes were
+    # spilled to disk
+    largest_transaction = 0, 0
+    spilled_transactions = 0
 
     def _copyNewTrans(self, input_pos, output, index, acquire=None, release=None):
-        tindex = {}
+        tindex = TransactionIndex(os.path.dirname(os.path.abspath(self._name)))
         copier = PackCopier(output, index, tindex)
         th = self._read_txn_header(input_pos)
         if release is not None:
             release()
 
         transform = self.transform
+        dedup = self.dedup
+        backpointers = self.backpointers
         start_time = time.time()
         output_tpos = output.tell()
         copier.setTxnPos(output_tpos)
@@ -202,9 +622,18 @@ class FileStoragePacker(FileStorageFormatter):
         input_pos += th.headerlen()
         while input_pos < tend:
             h = self._read_data_header(input_pos)
+            here = output.tell()
+            back = 0
             prev_txn = None
             if h.plen:
                 data = self._file.read(h.plen)
+            elif h.back and backpointers is not None:
+                # If the record the backpointer points to was copied,
+                # point to the copy.  Otherwise, it was dropped and we
+                # need to write the data in the new record.
+                back = backpointers.get(p64(h.back))
+                if not back:
+                    data = self.fetchBackpointer(h.oid, h.back)
             else:
                 # If a current record has a backpointer, fetch
                 # refs and data from the backpointer.  We need
@@ -213,9 +642,25 @@ class FileStoragePacker(FileStorageFormatter):
                 if h.back:
                     prev_txn = self.getTxnFromData(h.oid, h.back)
 
-            if data and (transform is not None):
-                data = transform(data)
-            copier.copy(h.oid, h.tid, data, prev_txn, output_tpos, output.tell())
+            if not back:
+                if data and (transform is not None):
+                    data = transform(data)
+                if dedup is not None and data and prev_txn is None:
+                    back, digest = dedup.find(h.oid, data)
+                    if not back:
+                        dedup.remember(h.oid, digest, here)
+
+            if back:
+                copier.copyBackpointer(h.oid, h.tid, back, output_tpos, here)
+            else:
+                copier.copy(h.oid, h.tid, data, prev_txn, output_tpos, here)
+                if data:
+                    back = here
+
+            if back and backpointers is not None:
+                key = p64(input_pos)
+                if key in backpointers:
+                    backpointers[key] = back
 
             input_pos += h.recordlen()
 
@@ -231,6 +676,15 @@ class FileStoragePacker(FileStorageFormatter):
             output.seek(output_pos)
 
         index.update(tindex)
+        if self.checksums is not None:
+            # Read the transaction back before taking the lock again.
+            self.checksums.transaction(output, output_tpos, output_pos)
+        if self.tids is not None:
+            self.tids.add(th.tid, output_tpos)
+        if len(tindex) > self.largest_transaction[0]:
+            self.largest_transaction = len(tindex), output_pos - output_tpos
+        if tindex.spilled:
+            self.spilled_transactions += 1
         tindex.clear()
         time.sleep((time.time() - start_time) * self.sleep)
 
@@ -245,6 +699,40 @@ class FileStoragePacker(FileStorageFormatter):
         data, tid = self._loadBackTxn(oid, back, 0)
         return data
 
+    def logCopyStats(self, log):
+        # Log the largest transaction copied and peak memory use, if
+        # any transactions were copied.  They're only logged at INFO
+        # level if transaction indexes were spilled to disk.
+        records, size = self.largest_transaction
+        if not records:
+            return
+        level = logging.INFO if self.spilled_transactions else logging.DEBUG
+        log(level, "largest transaction copied: %s records, %s bytes", records, size)
+        if self.spilled_transactions:
+            log(
+                level,
+                "%s transaction indexes spilled to disk",
+                self.spilled_transactions,
+            )
+        rss = max_rss()
+        if rss is not None:
+            log(level, "peak memory use: %s KB", rss)
+
+
+def _sender(f):
+    # Return a function that sends commands to a subprocess
+    lock = threading.Lock()
+
+    def send(command):
+        with lock:
+            try:
+                f.write(command)
+                f.flush()
+            except (IOError, OSError, ValueError):
+                pass  # It's already gone
+
+    return send
+
 
 class PackCopier(ZODB.FileStorage.fspack.PackCopier):
     def _txn_find(self, tid, stop_at_pack):
@@ -264,6 +752,362 @@ class PackCopier(ZODB.FileStorage.fspack.PackCopier):
 
         return None
 
+    def copyBackpointer(self, oid, serial, back, txnpos, datapos):
+        # Write a record whose data is that of the record at `back`.
+        self._tindex[oid] = datapos
+        h = DataHeader(oid, serial, self._index.get(oid, 0), txnpos, 0, 0)
+        self._file.write(h.asString())
+        self._file.write(p64(back))
+
+
+class DuplicateFinder(object):
+    """Find records identical to earlier revisions of the same objects
+
+    A digest of the data written for an object's last revision, and
+    where it was written, are remembered for up to `capacity` objects.
+    The least recently written objects are forgotten first.
+
+    Finders are only used by the pack subprocess.  Transactions
+    committed during the pack are copied by the storage's process
+    without one, so they're never deduplicated.
+    """
+
+    capacity = 100000
+
+    def __init__(self, capacity=None):
+        if capacity:
+            self.capacity = capacity
+        self.records = collections.OrderedDict()  # {oid -> (digest, pos)}
+        self.found = self.found_bytes = 0
+
+    def find(self, oid, data):
+        """Return the position of a record with the same data, or 0,
+        and the data's digest
+        """
+        digest = self.digest(data)
+        record = self.records.get(oid)
+        if record is not None and record[0] == digest:
+            self.found += 1
+            self.found_bytes += len(data)
+            return record[1], digest
+        return 0, digest
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(data).digest()
+
+    def remember(self, oid, digest, pos):
+        records = self.records
+        records.pop(oid, None)
+        records[oid] = digest, pos
+        if len(records) > self.capacity:
+            records.popitem(False)
+
+
+_copying = None  # The packer and index used by _copySegment
+
+
+class PackBudget(object):
+    """Limits on the time taken and bytes copied by a run of a pack
+
+    When either is spent before the pack time is reached, the run
+    stops copying and its progress is saved, so the next pack can pick
+    up where it stopped.  The first transaction of a run is always
+    copied, so every run makes progress.
+
+    Only copying counts against the budget; its clock is started with
+    ``start`` when copying starts.  The first run always scans the
+    whole file, to build the index of current records and find
+    backpointer targets, before it copies anything.  Later runs reuse
+    what it found, only scanning transactions committed since.
+    """
+
+    def __init__(self, seconds=None, size=None):
+        self.seconds = seconds
+        self.size = size
+        self.start()
+        self.start_pos = self.stopped = None
+
+    def start(self):
+        self.start_time = time.time()
+
+    def spent(self, pos):
+        """Return whether the budget is spent, having copied to `pos`
+        """
+        if self.start_pos is None:
+            self.start_pos = pos
+            return False
+        if (self.size is not None and pos - self.start_pos >= self.size) or (
+            self.seconds is not None and time.time() - self.start_time >= self.seconds
+        ):
+            self.stopped = pos
+            return True
+        return False
+
+
+def _copySegment(args):
+    packer, index = _copying
+    start, end, path = args
+    return packer.copySegment(start, end, path, index)
+
+
+def _placeSegment(args):
+    # Patch the transaction positions in the data records of a segment
+    # for its position in the output, and copy it there.
+    path, output_path, offset = args
+    with open(path, "r+b") as segment:
+        segment.seek(0, 2)
+        size = segment.tell()
+        tpos = 0
+        while tpos < size:
+            segment.seek(tpos)
+            th = TxnHeaderFromString(segment.read(TRANS_HDR_LEN))
+            tend = tpos + th.tlen
+            pos = tpos + th.headerlen()
+            while pos < tend:
+                segment.seek(pos)
+                h = DataHeaderFromString(segment.read(DATA_HDR_LEN))
+                h.tloc = tpos + offset
+                segment.seek(pos)
+                segment.write(h.asString())
+                pos += h.recordlen()
+            tpos = tend + 8
+
+        segment.seek(0)
+        with open(output_path, "r+b") as output:
+            output.seek(offset)
+            copy_file(segment, output)
+    os.remove(path)
+
+
+class MappedFile(object):
+    """A read-only file-like view of the first `size` bytes of a file
+
+    The file is memory mapped, so reads are served without system
+    calls.
+    """
+
+    def __init__(self, path, size):
+        self.name = path
+        self.size = size
+        self._file = open(path, "rb")
+        if size:
+            self.map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        else:
+            self.map = None
+        self.pos = 0
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        pos = self.pos
+        if size < 0:
+            end = self.size
+        else:
+            end = min(pos + size, self.size)
+        if end <= pos:
+            return b""
+        self.pos = end
+        return self.map[pos:end]
+
+    def dontneed(self, end):
+        """Tell the system we don't need the pages before `end`
+        """
+        madvise = getattr(self.map, "madvise", None)
+        end -= end % mmap.PAGESIZE
+        if madvise is not None and end > 0:
+            madvise(mmap.MADV_DONTNEED, 0, end)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self._file.close()
+
+
+class CommittedReader(object):
+    """A buffered, read-only file-like view of committed transactions
+
+    Reads stop at `end`, the end of the transactions committed when
+    it was last set, as if it was the end of the file.  Data before
+    `end` doesn't change, so it can be buffered without risk of
+    reading data still being written by the storage.
+    """
+
+    buffer_size = 1 << 16
+
+    def __init__(self, path, end):
+        self.name = path
+        self.end = end
+        self._file = open(path, "rb", 0)
+        self.pos = 0
+        self.buffer = b""
+        self.buffer_pos = 0
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.end
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        pos = self.pos
+        if size < 0:
+            size = self.end - pos
+        else:
+            size = min(size, self.end - pos)
+        if size <= 0:
+            return b""
+        offset = pos - self.buffer_pos
+        if offset < 0 or offset + size > len(self.buffer):
+            self._file.seek(pos)
+            self.buffer = self._file.read(
+                min(max(size, self.buffer_size), self.end - pos)
+            )
+            self.buffer_pos = pos
+            offset = 0
+        data = self.buffer[offset : offset + size]
+        self.pos = pos + len(data)
+        return data
+
+    def close(self):
+        self.buffer = b""
+        self._file.close()
+
+
+class TransactionIndex(object):
+    """The positions of the records written for a transaction
+
+    This is used in place of a dictionary to collect index updates
+    while a transaction is copied.  Oids and positions are appended to
+    a byte array, 16 bytes per record.  When there are more than
+    `capacity` records, they're spilled to a temporary file in
+    `directory`, so memory use is bounded no matter how big a
+    transaction is.
+    """
+
+    capacity = 1 << 16
+
+    def __init__(self, directory=None, capacity=None):
+        self.directory = directory
+        if capacity:
+            self.capacity = capacity
+        self.records = bytearray()
+        self.file = None
+        self.spilled = 0
+
+    def __setitem__(self, oid, pos):
+        self.records += oid + p64(pos)
+        if len(self.records) >= self.capacity * 16:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(dir=self.directory)
+            self.file.write(self.records)
+            self.spilled += len(self.records) // 16
+            del self.records[:]
+
+    def __len__(self):
+        return self.spilled + len(self.records) // 16
+
+    def _chunks(self):
+        if self.file is not None:
+            self.file.seek(0)
+            while 1:
+                chunk = self.file.read(self.capacity * 16)
+                if not chunk:
+                    break
+                yield chunk
+        yield bytes(self.records)
+
+    def items(self):
+        """Return an iterator of oids and positions, in the order written
+        """
+        for chunk in self._chunks():
+            for i in range(0, len(chunk), 16):
+                yield chunk[i : i + 8], u64(chunk[i + 8 : i + 16])
+
+    def clear(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        del self.records[:]
+        self.spilled = 0
+
+
+class PositionQueue(object):
+    """Positions of records to visit, read back in file order
+
+    Positions are collected in a list, up to `capacity` of them.  Then
+    they're sorted and spilled to a temporary file in `directory`, 8
+    bytes each, as a run.  Runs are merged when the positions are read,
+    so memory use is bounded no matter how many are queued.
+    """
+
+    capacity = 1 << 18
+
+    def __init__(self, directory=None, capacity=None):
+        self.directory = directory
+        if capacity:
+            self.capacity = capacity
+        self.positions = []
+        self.file = None
+        self.runs = []
+
+    def append(self, pos):
+        self.positions.append(pos)
+        if len(self.positions) >= self.capacity:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(dir=self.directory)
+            self.positions.sort()
+            self.file.seek(0, 2)
+            self.runs.append((self.file.tell(), len(self.positions)))
+            self.file.write(b"".join(p64(pos) for pos in self.positions))
+            del self.positions[:]
+
+    def __len__(self):
+        return sum(n for (_, n) in self.runs) + len(self.positions)
+
+    def _run(self, start, n):
+        # Read a spilled run back a chunk at a time.  Runs are merged,
+        # so we seek before each read.
+        while n:
+            self.file.seek(start)
+            count = min(n, 8192)
+            chunk = self.file.read(count * 8)
+            for i in range(0, len(chunk), 8):
+                yield u64(chunk[i : i + 8])
+            start += count * 8
+            n -= count
+
+    def __iter__(self):
+        self.positions.sort()
+        runs = [self._run(start, n) for (start, n) in self.runs]
+        return heapq.merge(self.positions, *runs)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        del self.positions[:]
+        del self.runs[:]
+
 
 pack_script_template = """
 
@@ -283,8 +1127,16 @@ logging.getLogger().addHandler(handler)
 try:
     packer = zc.FileStorage.PackProcess(%(path)r, %(stop)r, %(size)r,
                                         %(blob_dir)r, %(sleep)s,
-                                        %(transform)r, %(untransform)r)
-    packer.pack()
+                                        %(transform)r, %(untransform)r,
+                                        **%(options)r)
+    packer.control = zc.FileStorage.PackControl(
+        sys.stdin.fileno(), zc.FileStorage.print_progress)
+    result = packer.pack()
+    if result is not None:
+        # Save the index so the parent process can use it as a
+        # starting point.
+        with open(%(path)r+'.packindex', 'wb') as f:
+            pickle.Pickler(f, 1).dump(result)
 except Exception as v:
     logging.exception('packing')
     try:
@@ -299,6 +1151,9 @@ except Exception as v:
 
 
 class PackProcess(FileStoragePacker):
+
+    control = None
+
     def __init__(
         self,
         path,
@@ -308,25 +1163,56 @@ class PackProcess(FileStoragePacker):
         sleep=0,
         transform=None,
         untransform=None,
+        report=None,
+        garbage=None,
+        dedup=None,
+        compress=None,
+        checksums=False,
+        verify=False,
+        checks="full",
+        pack_dir=None,
+        preallocate=False,
+        map_input=False,
+        copy_processes=None,
+        archive=None,
+        tids=False,
+        time_budget=None,
+        byte_budget=None,
+        scheduler=None,
+        slots=1,
+        rate=None,
+        priority=0,
+        stream=None,
+        warmup=None,
+        warmup_oids=None,
     ):
         self._name = path
+        self.warmup = warmup
+        self.warmup_oids = warmup_oids
         # We open our own handle on the storage so that much of pack can
         # proceed in parallel.  It's important to close this file at every
         # return point, else on Windows the caller won't be able to rename
         # or remove the storage file.
 
+        self.blob_dir = blob_dir
         if blob_dir:
             self.pack_blobs = True
-            self.blob_removed = open(os.path.join(blob_dir, ".removed"), "wb")
+            # A resumed pack adds to the blobs removed by earlier runs.
+            if (time_budget or byte_budget) and os.path.exists(path + ".packstate"):
+                mode = "ab"
+            else:
+                mode = "wb"
+            self.blob_removed = open(os.path.join(blob_dir, ".removed"), mode)
         else:
             self.pack_blobs = False
 
-        self._file = open(path, "rb")
+        self.file_end = current_size
+        self.map_input = map_input
+        self._file = self._openInput()
 
         self._name = path
         self._stop = stop
         self.locked = 0
-        self.file_end = current_size
 
         self.ltid = z64
 
@@ -337,53 +1223,530 @@ class PackProcess(FileStoragePacker):
         self.transform = transform
         if isinstance(untransform, str):
             untransform = getglobal(untransform)
+        if compress:
+            import zc.FileStorage.compression
+
+            if transform is not None:
+                raise ValueError("compress and transform can't be used together")
+            compressor = zc.FileStorage.compression.Compressor(
+                None if compress is True else compress
+            )
+            self.transform = compressor.compress
+            if untransform is None:
+                untransform = zc.FileStorage.compression.decompress
+        else:
+            compressor = None
+        self.compressor = compressor
+        self.write_checksums = checksums
+        self.write_tids = tids
+        self.verify = verify
+        if checks not in ("full", "headers"):
+            checks = int(checks)
+            if checks < 1:
+                raise ValueError("Invalid checks", checks)
+        self.checks = checks
+        self.pack_dir = pack_dir
+        self.preallocate = preallocate
         self.untransform = untransform
+        if copy_processes and report:
+            raise ValueError("copy_processes and report can't be used together")
+        if copy_processes and archive:
+            raise ValueError("copy_processes and archive can't be used together")
+        self.copy_processes = copy_processes
+        self.archive_path = archive
+        if time_budget or byte_budget:
+            if copy_processes:
+                raise ValueError("budgets and copy_processes can't be used together")
+            if report:
+                raise ValueError("budgets and report can't be used together")
+            self.budget = PackBudget(time_budget, byte_budget)
+        else:
+            self.budget = None
+        if scheduler:
+            import zc.FileStorage.scheduler
+
+            scheduler = zc.FileStorage.scheduler.Scheduler(scheduler, slots, rate)
+        self.scheduler = scheduler
+        self.priority = priority
+        self.stream_path = stream
+        if report:
+            if report is True:
+                report = PackReport.top
+            report = PackReport(report, untransform)
+        else:
+            report = None
+        self.report = report
+        if garbage is not None:
+            garbage = load_garbage(garbage)
+        self.garbage = garbage
+        self.garbage_blobs = set()
+        if dedup:
+            dedup = DuplicateFinder(None if dedup is True else dedup)
+        else:
+            dedup = None
+        self.dedup = dedup
         logging.info(
             "packing to %s, sleep %s", ZODB.TimeStamp.TimeStamp(self._stop), self.sleep
         )
 
+    def _openInput(self):
+        if self.map_input:
+            # Most reads are random reads of data records pointed to by
+            # backpointers.  Serve them from memory without system calls.
+            return MappedFile(self._name, self.file_end)
+        return open(self._name, "rb")
+
     def _read_txn_header(self, pos, tid=None):
         self._freecache(pos)
         return FileStoragePacker._read_txn_header(self, pos, tid)
 
-    def pack(self, snapshot_in_time_path=None):
-        packed, index, packpos = self.buildPackIndex(self._stop, self.file_end)
-        logging.info("initial scan %s objects at %s", len(index), packpos)
+    def pack(self, snapshot_in_time_path=None, roots=None, frozen_index=False):
+        if self.scheduler is None:
+            return self._pack(snapshot_in_time_path, roots, frozen_index)
+
+        # Wait our turn, then keep to our share of the I/O rate.
+        slot = self.scheduler.acquire(
+            self._name, self.file_end, self.priority, self.control
+        )
+        control = self.control
+        self.control = slot
+        packed_size = None
+        try:
+            result = self._pack(snapshot_in_time_path, roots, frozen_index)
+            if result is not None:
+                packed_size = result[1]
+            return result
+        finally:
+            self.control = control
+            slot.release(packed_size)
+
+    def _pack(self, snapshot_in_time_path, roots, frozen_index):
+        state = None
+        if snapshot_in_time_path:
+            self.budget = None
+        elif self.budget is not None:
+            state = self.loadPackState()
+        if state is None:
+            packed, index, packpos = self.buildPackIndex(self._stop, self.file_end)
+            logging.info("initial scan %s objects at %s", len(index), packpos)
+        else:
+            # Resume an earlier run that spent its budget, packing to
+            # the same time.
+            packed = False
+            index, packpos = state["index"], state["packpos"]
+            self._stop = state["stop"]
+            self.garbage_blobs.update(state["garbage_blobs"])
+            logging.info(
+                "resuming pack to %s at %s of %s",
+                ZODB.TimeStamp.TimeStamp(self._stop),
+                state["pos"],
+                packpos,
+            )
+
+        if self.garbage is not None:
+            # Drop garbage found by an external garbage collector, such
+            # as zc.zodbdgc, as if it had been deleted before the pack
+            # time, rather than waiting for the collector to write
+            # deletion records for the next pack to remove.
+            removed = 0
+            for oid in self.garbage:
+                if oid in index:
+                    del index[oid]
+                    removed += 1
+            logging.info("removing %s garbage objects", removed)
+            if removed:
+                packed = False
+
         if packed:
             # nothing to do
             logging.info("done, nothing to do")
             self._file.close()
             return
 
+        if snapshot_in_time_path and roots is not None:
+            # Only copy objects reachable from the given roots.
+            index = self.reachableIndex(index, roots)
+            logging.info("%s reachable objects", len(index))
+
+        if state is not None:
+            # Earlier runs found the targets up to where the file ended
+            # then, and where those copied so far were copied.
+            self.backpointers = state["targets"]
+            if state["file_end"] < self.file_end:
+                logging.info("finding backpointers from %s", state["file_end"])
+                for key in self.backpointerTargets(state["file_end"], self.file_end):
+                    if key not in self.backpointers:
+                        self.backpointers[key] = 0
+        elif not snapshot_in_time_path:
+            self.backpointers = self.backpointerTargets(packpos, self.file_end)
+        if not snapshot_in_time_path:
+            if self.backpointers:
+                logging.info("%s backpointer targets", len(self.backpointers))
+
+        pack_path = self._name + ".pack"
+        if snapshot_in_time_path:
+            output_path = snapshot_in_time_path
+        elif state is not None:
+            output_path = state["output_path"]
+        elif self.pack_dir:
+            # Write to another directory, typically on a faster or
+            # otherwise idle device, and move the output next to the
+            # storage when we're done.
+            output_path = os.path.join(
+                self.pack_dir, os.path.basename(self._name) + ".pack"
+            )
+            self.checkPackSpace(output_path, pack_path)
+            logging.info("writing pack output to %s", output_path)
+        else:
+            output_path = pack_path
+
         logging.info("copy to pack time")
-        with open(snapshot_in_time_path or (self._name + ".pack"), "w+b") as output:
-            self._freeoutputcache = _freefunc(output)
-            index, new_pos = self.copyToPacktime(packpos, index, output)
-            if snapshot_in_time_path:
-                # We just want a snapshot in time, containing current records as
-                # of that time.
-                index.save(packpos, snapshot_in_time_path + ".index")
-                return
+        if self.budget is not None:
+            self.budget.start()
+        try:
+            with open(output_path, "w+b" if state is None else "r+b") as output:
+                self._freeoutputcache = _freefunc(output)
+                if state is not None:
+                    preallocated = state["preallocated"]
+                else:
+                    # The output is usually no bigger than what we're
+                    # packing.  Reserving that much up front lets the
+                    # file system lay it out contiguously.  The unused
+                    # tail is truncated when we're done, and if the
+                    # output is bigger, it grows past the reservation.
+                    preallocated = self.preallocate and preallocate(
+                        output, packpos if snapshot_in_time_path else self.file_end
+                    )
+                if self.stream_path:
+                    import zc.FileStorage.stream
 
-            if new_pos == packpos:
-                # pack didn't free any data.  there's no point in continuing.
-                self._file.close()
-                os.remove(self._name + ".pack")
-                logging.info("done, no decrease")
-                return
+                    # The output is read back to be streamed, so it's
+                    # left in the cache.
+                    self.streamer = zc.FileStorage.stream.Streamer(
+                        output, self.stream_path
+                    )
+                    self._freeoutputcache = self.streamer.written
+                if self.write_checksums:
+                    import zc.FileStorage.checksums
 
-            logging.info("copy from pack time")
-            self._freecache = self._freeoutputcache = lambda pos: None
-            self.copyFromPacktime(packpos, self.file_end, output, index)
+                    self.checksums = zc.FileStorage.checksums.ChecksumWriter(
+                        output_path + ".checksums", append=state is not None
+                    )
+                if self.write_tids:
+                    import zc.FileStorage.tids
 
-            # Save the index so the parent process can use it as a starting point.
-            with open(self._name + ".packindex", "wb") as f:
-                pickle.Pickler(f, 1).dump((index, output.tell()))
+                    self.tids = zc.FileStorage.tids.TidWriter(
+                        output_path + ".tids", append=state is not None
+                    )
+                if self.archive_path and not snapshot_in_time_path:
+                    import zc.FileStorage.archive
 
-            output.flush()
-            os.fsync(output.fileno())
+                    self.archive = zc.FileStorage.archive.Archive(
+                        self.archive_path, self.blob_dir
+                    )
+                try:
+                    if state is None:
+                        copied, new_pos = self.copyToPacktime(packpos, index, output)
+                    else:
+                        copied, new_pos = self.resumeCopy(state, packpos, index, output)
+                finally:
+                    self.closeArchive()
+                if self.budget is not None and self.budget.stopped is not None:
+                    # We didn't reach the pack time.  Save our progress
+                    # so the next pack can pick up where we stopped.
+                    self.savePackState(
+                        output, output_path, packpos, index, copied, preallocated
+                    )
+                    self._file.close()
+                    self.closeChecksums()
+                    self.closeTids()
+                    self.closeStreamer(abort=True)
+                    return
+                index = copied
+                if self.report is not None:
+                    with open(self._name + ".packreport", "w") as f:
+                        self.report.write(f)
+                    logging.info("wrote %s", self._name + ".packreport")
+                if snapshot_in_time_path:
+                    # We just want a snapshot in time, containing current
+                    # records as of that time.
+                    if preallocated:
+                        output.truncate(new_pos)
+                    index.save(new_pos, snapshot_in_time_path + ".index")
+                    if frozen_index:
+                        import zc.FileStorage.frozen
+
+                        zc.FileStorage.frozen.save(
+                            index, new_pos, snapshot_in_time_path + ".oids"
+                        )
+                    self.closeChecksums()
+                    self.closeTids()
+                    self.closeStreamer(end=new_pos)
+                    return
+
+                if new_pos == packpos:
+                    # pack didn't free any data.  there's no point in
+                    # continuing.
+                    self._file.close()
+                    os.remove(output_path)
+                    self.closeChecksums(remove=True)
+                    self.closeTids(remove=True)
+                    self.removePackState()
+                    self.closeStreamer(abort=True)
+                    logging.info("done, no decrease")
+                    return
+
+                logging.info("copy from pack time")
+                self._freecache = lambda pos: None
+                if self.streamer is None:
+                    self._freeoutputcache = lambda pos: None
+                self.copyFromPacktime(packpos, self.file_end, output, index)
+                opos = output.tell()
+                if preallocated:
+                    output.truncate(opos)
+                if self.compressor is not None:
+                    logging.info(self.compressor.stats())
+                if self.dedup is not None:
+                    logging.info(
+                        "%s duplicate records (%s bytes) replaced by backpointers",
+                        self.dedup.found,
+                        self.dedup.found_bytes,
+                    )
+                self.logCopyStats(logging.log)
+
+                for oid in sorted(self.garbage_blobs):
+                    if oid not in index:
+                        # No longer used, so remove the blob directory.
+                        self.blob_removed.write(binascii.hexlify(oid) + b"\n")
+
+                output.flush()
+                os.fsync(output.fileno())
+                self._file.close()
+                self.closeChecksums()
+                self.closeTids()
+                self.removePackState()
+                # The storage's process streams the rest.
+                self.closeStreamer(opos)
+        except PackCancelled:
             self._file.close()
+            os.remove(output_path)
+            self.closeChecksums(remove=True)
+            self.closeTids(remove=True)
+            self.removePackState()
+            self.closeStreamer(abort=True)
+            raise
+
+        if output_path != pack_path:
+            start_time = time.time()
+            move_file(output_path, pack_path)
+            if self.write_checksums:
+                move_file(output_path + ".checksums", pack_path + ".checksums")
+            if self.write_tids:
+                move_file(output_path + ".tids", pack_path + ".tids")
+            logging.info(
+                "moved %s to %s in %.1f seconds",
+                output_path,
+                pack_path,
+                time.time() - start_time,
+            )
+            output_path = pack_path
+
+        if self.verify:
+            import zc.FileStorage.verify
+
+            try:
+                zc.FileStorage.verify.verify(
+                    output_path,
+                    index,
+                    self._metadata_size,
+                    opos,
+                    None if self.verify is True else self.verify,
+                )
+            except Exception:
+                # Don't leave a bad file, or its sidecars, to be used.
+                remove_output(output_path)
+                raise
+
+        if self.warmup or self.warmup_oids:
+            self.saveWarmup(index)
+
         logging.info("packscript done")
+        return index, opos
+
+    def saveWarmup(self, index):
+        # Choose the records of the packed file to warm, and save their
+        # positions for the storage's process, which warms them once
+        # the packed file replaces the storage's.
+        import zc.FileStorage.warmup
+
+        warmup = self.warmup
+        if isinstance(warmup, bool):
+            warmup = None
+        if self.warmup_oids:
+            # Listed records are all warmed, unless there's a limit.
+            oids = zc.FileStorage.warmup.load_oids(self.warmup_oids)
+        else:
+            oids = None
+            if warmup is None:
+                warmup = zc.FileStorage.warmup.limit
+        zc.FileStorage.warmup.save_positions(
+            self._name + ".packwarmup",
+            zc.FileStorage.warmup.positions(index, oids, warmup),
+        )
+
+    def loadPackState(self):
+        # Return the saved state of an earlier run of a budgeted pack,
+        # if it's still usable.
+        import zc.FileStorage.packstate
+
+        try:
+            loaded = zc.FileStorage.packstate.load(self._name)
+            if loaded is None:
+                return None
+            state, index, copied, targets = loaded
+            packpos = state["packpos"]
+            if (
+                state["file_end"] <= self.file_end
+                and os.path.exists(state["output_path"])
+                and os.path.getsize(state["output_path"]) >= state["opos"]
+                and self._tidBefore(packpos) == state["packtid"]
+            ):
+                state["index"] = index
+                state["copied"] = copied
+                state["targets"] = targets
+                return state
+            logging.warning("ignoring pack state that doesn't match the storage")
+        except Exception:
+            logging.exception("ignoring pack state that couldn't be loaded")
+
+        zc.FileStorage.packstate.remove(self._name)
+        if self.pack_blobs:
+            # Forget blobs removed by the abandoned pack.
+            self.blob_removed.seek(0)
+            self.blob_removed.truncate()
+        return None
+
+    def savePackState(self, output, output_path, packpos, index, copied, preallocated):
+        # Save the progress of a pack whose budget was spent, so the
+        # next pack can resume it.
+        import zc.FileStorage.packstate
+
+        opos = output.tell()
+        output.flush()
+        os.fsync(output.fileno())
+        sizes = {}
+        for name, f in self.sidecars().items():
+            f.flush()
+            sizes[name] = os.fstat(f.fileno()).st_size
+        targets = self.backpointers
+        if targets is None:
+            targets = ZODB.fsIndex.fsIndex()
+        zc.FileStorage.packstate.save(
+            self._name,
+            dict(
+                stop=self._stop,
+                file_end=self.file_end,
+                packpos=packpos,
+                packtid=self._tidBefore(packpos),
+                pos=self.budget.stopped,
+                opos=opos,
+                output_path=output_path,
+                preallocated=preallocated,
+                garbage_blobs=sorted(self.garbage_blobs),
+                sizes=sizes,
+            ),
+            index,
+            copied,
+            targets,
+        )
+        logging.info(
+            "pack budget spent at %s of %s, %s bytes written",
+            self.budget.stopped,
+            packpos,
+            opos,
+        )
+
+    def removePackState(self):
+        if self.budget is not None:
+            import zc.FileStorage.packstate
+
+            zc.FileStorage.packstate.remove(self._name)
+
+    def sidecars(self):
+        # The files, other than the output, that packing appends to
+        files = {}
+        if self.pack_blobs:
+            files["removed"] = self.blob_removed
+        if self.checksums is not None:
+            files["checksums"] = self.checksums.file
+        if self.tids is not None:
+            files["tids"] = self.tids.file
+        return files
+
+    def _tidBefore(self, pos):
+        # Return the id of the transaction ending at `pos`
+        self._file.seek(pos - 8)
+        tpos = pos - 8 - u64(self._file.read(8))
+        return self._read_txn_header(tpos).tid
+
+    def resumeCopy(self, state, packpos, index, output):
+        # Copy to the pack time from where an earlier run stopped,
+        # discarding anything written after its progress was saved.
+        output.seek(state["opos"])
+        if not state["preallocated"]:
+            output.truncate()
+        for name, f in self.sidecars().items():
+            f.flush()
+            f.truncate(state["sizes"].get(name, 0))
+        copied = state["copied"]
+        new_index, new_pos = self.copyRange(state["pos"], packpos, index, output)
+        copied.update(new_index)
+        return copied, new_pos
+
+    def checkPackSpace(self, output_path, pack_path):
+        # If the output is written to another file system, there needs
+        # to be room for it on both.
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        pack_dir = os.path.dirname(os.path.abspath(pack_path))
+        needed = pack_space_needed(self.file_end)
+        check_free_space(output_dir, needed)
+        if os.stat(output_dir).st_dev != os.stat(pack_dir).st_dev:
+            check_free_space(pack_dir, needed)
+
+    archive = None
+
+    def closeArchive(self):
+        archive = self.archive
+        if archive is not None:
+            archive.close()
+            logging.info(
+                "archived %s transactions, %s records",
+                archive.transactions,
+                archive.records,
+            )
+            self.archive = None
+
+    def closeChecksums(self, remove=False):
+        checksums = self.checksums
+        if checksums is not None:
+            checksums.close()
+            if remove:
+                os.remove(checksums.path)
+            else:
+                logging.info("%s record checksums written", checksums.records)
+            self.checksums = None
+
+    def closeTids(self, remove=False):
+        tids = self.tids
+        if tids is not None:
+            tids.close()
+            if remove:
+                os.remove(tids.path)
+            else:
+                logging.info("%s transaction positions written", tids.transactions)
+            self.tids = None
+
+    checks = "full"
 
     def buildPackIndex(self, stop, file_end):
         index = ZODB.fsIndex.fsIndex()
@@ -391,12 +1754,36 @@ class PackProcess(FileStoragePacker):
         packed = True
         log_pos = pos
 
+        # Records are checked fully, or just transaction headers are
+        # checked, or every nth transaction is checked fully.
+        checks = self.checks
+        if checks == "headers":
+            logging.info(
+                "checking transaction headers only, "
+                "not data records or redundant transaction lengths"
+            )
+            check_txn, check_data = True, False
+        elif checks != "full":
+            logging.info("checking every %s transactions", checks)
+        else:
+            check_txn = check_data = True
+        transactions = skipped = 0
+
+        control = self.control
         while pos < file_end:
+            if control is not None:
+                control.check("index", pos, file_end)
             start_time = time.time()
             th = self._read_txn_header(pos)
             if th.tid > stop:
                 break
-            self.checkTxn(th, pos)
+            if checks not in ("full", "headers"):
+                check_txn = check_data = not transactions % checks
+                if not check_txn:
+                    skipped += 1
+            transactions += 1
+            if check_txn:
+                self.checkTxn(th, pos)
             if th.status != "p":
                 packed = False
 
@@ -406,7 +1793,8 @@ class PackProcess(FileStoragePacker):
 
             while pos < end:
                 dh = self._read_data_header(pos)
-                self.checkData(th, tpos, dh, pos)
+                if check_data:
+                    self.checkData(th, tpos, dh, pos)
                 if dh.plen or dh.back:
                     index[dh.oid] = pos
                 else:
@@ -415,15 +1803,16 @@ class PackProcess(FileStoragePacker):
                         del index[dh.oid]
                 pos += dh.recordlen()
 
-            tlen = self._read_num(pos)
-            if tlen != th.tlen:
-                self.fail(
-                    pos,
-                    "redundant transaction length does not "
-                    "match initial transaction length: %d != %d",
-                    tlen,
-                    th.tlen,
-                )
+            if check_data:
+                tlen = self._read_num(pos)
+                if tlen != th.tlen:
+                    self.fail(
+                        pos,
+                        "redundant transaction length does not "
+                        "match initial transaction length: %d != %d",
+                        tlen,
+                        th.tlen,
+                    )
             pos += 8
 
             if pos - log_pos > GIG:
@@ -432,42 +1821,264 @@ class PackProcess(FileStoragePacker):
 
             time.sleep((time.time() - start_time) * self.sleep)
 
+        if skipped:
+            logging.info(
+                "skipped checks of %s of %s transactions", skipped, transactions
+            )
+
         return packed, index, pos
 
+    def backpointerTargets(self, pos, file_end):
+        """Return the positions of records pointed to by backpointers
+        in the transactions from `pos`
+
+        They're returned as the keys of an fsIndex.  As records are
+        copied, the values are set to the positions of the copies.
+        Backpointers can then be kept rather than replaced by the data
+        they point to, unless the records pointed to were dropped.
+        """
+        targets = ZODB.fsIndex.fsIndex()
+        control = self.control
+        while pos < file_end:
+            if control is not None:
+                control.check("find backpointers", pos, file_end)
+            th = self._read_txn_header(pos)
+            tend = pos + th.tlen
+            pos += th.headerlen()
+            while pos < tend:
+                h = self._read_data_header(pos)
+                if h.back and not h.plen:
+                    targets[p64(h.back)] = 0
+                pos += h.recordlen()
+            pos += 8
+
+        return targets
+
+    def reachableIndex(self, index, roots):
+        """Return the part of `index` reachable from the `roots` oids
+
+        The walk is breadth first, a level at a time, and each level
+        is visited in file order so that reads sweep forward through
+        the file.  Oids are added to the returned index as they're
+        queued, so it doubles as the visited set and each object is
+        queued once.  Levels are queued as record positions in a
+        ``PositionQueue``, which spills large levels to disk.
+        """
+        reachable = ZODB.fsIndex.fsIndex()
+        untransform = self.untransform
+        referencesf = ZODB.serialize.referencesf
+        directory = os.path.dirname(os.path.abspath(self._name))
+        level = PositionQueue(directory)
+        for oid in roots:
+            pos = index.get(oid)
+            if pos is not None and oid not in reachable:
+                reachable[oid] = pos
+                level.append(pos)
+        while level:
+            next_level = PositionQueue(directory)
+            for pos in level:
+                h = self._read_data_header(pos)
+                if h.plen:
+                    data = self._file.read(h.plen)
+                else:
+                    data = self.fetchBackpointer(h.oid, h.back)
+                if not data:
+                    continue
+                if untransform is not None:
+                    data = untransform(data)
+                for ref in referencesf(data):
+                    if ref not in reachable:
+                        ref_pos = index.get(ref)
+                        if ref_pos is not None:
+                            reachable[ref] = ref_pos
+                            next_level.append(ref_pos)
+            level.close()
+            level = next_level
+
+        return reachable
+
+    def _blobRecordTest(self):
+        untransform = self.untransform
+        if untransform is None:
+            return ZODB.blob.is_blob_record
+
+        _is_blob_record = ZODB.blob.is_blob_record
+
+        def is_blob_record(data):
+            return _is_blob_record(untransform(data))
+
+        return is_blob_record
+
+    def estimate(self, sample=1.0, blobs=False):
+        """Estimate the effect of packing, without writing anything
+
+        The pack index is built as for a pack.  Then records before
+        the pack time are classified as kept or dropped.  If `sample`
+        is less than 1, only that fraction of the transactions are
+        examined and the results are scaled up by the fraction of
+        bytes examined.  If `blobs` is true, dropped blob revisions
+        are counted, which requires reading dropped records.
+
+        Durations are estimated from the time taken to build the
+        index and to read the examined transactions.  A dictionary of
+        results is returned.
+        """
+        start_time = time.time()
+        packed, index, packpos = self.buildPackIndex(self._stop, self.file_end)
+        index_seconds = time.time() - start_time
+
+        every = max(1, int(round(1.0 / sample)))
+        transform = self.transform
+        is_blob_record = self._blobRecordTest()
+        total_bytes = sampled_bytes = 0
+        sampled_seconds = 0.0
+        kept_records = kept_bytes = dropped_records = dropped_bytes = 0
+        blob_revisions = 0
+        pos = self._metadata_size
+        ntrans = 0
+        while pos < packpos:
+            th = self._read_txn_header(pos)
+            tend = pos + th.tlen
+            total_bytes += th.tlen + 8
+            ntrans += 1
+            if ntrans % every:
+                pos = tend + 8
+                continue
+
+            start_time = time.time()
+            sampled_bytes += th.tlen + 8
+            kept = False
+            pos += th.headerlen()
+            while pos < tend:
+                h = self._read_data_header(pos)
+                if index.get(h.oid) == pos:
+                    kept = True
+                    kept_records += 1
+                    if h.plen and transform is None:
+                        size = h.plen
+                    else:
+                        if h.plen:
+                            data = self._file.read(h.plen)
+                        else:
+                            data = self.fetchBackpointer(h.oid, h.back) or b""
+                        if transform is not None:
+                            data = transform(data)
+                        size = len(data) or 8
+                    kept_bytes += DATA_HDR_LEN + size
+                else:
+                    dropped_records += 1
+                    dropped_bytes += h.recordlen()
+                    if blobs:
+                        if h.plen:
+                            data = self._file.read(h.plen)
+                        else:
+                            data = self.fetchDataViaBackpointer(h.oid, h.back)
+                        if data and is_blob_record(data):
+                            # See the duplicate check in copyToPacktime.
+                            rpos = index.get(h.oid)
+                            is_dup = rpos and self._read_data_header(rpos).tid == h.tid
+                            if not is_dup:
+                                blob_revisions += 1
+                pos += h.recordlen()
+            if kept:
+                kept_bytes += th.headerlen() + 8
+            pos = tend + 8
+            sampled_seconds += time.time() - start_time
+
+        self._file.close()
+
+        scale = float(total_bytes) / sampled_bytes if sampled_bytes else 0.0
+        seconds_per_byte = sampled_seconds / sampled_bytes if sampled_bytes else 0.0
+        result = dict(
+            packed=packed,
+            objects=len(index),
+            input_size=self.file_end,
+            pack_pos=packpos,
+            sample=1.0 / every,
+            kept_records=int(kept_records * scale),
+            kept_bytes=int(kept_bytes * scale),
+            dropped_records=int(dropped_records * scale),
+            dropped_bytes=int(dropped_bytes * scale),
+            blob_revisions_removed=int(blob_revisions * scale),
+            index_seconds=index_seconds,
+        )
+        if packed:
+            result["output_size"] = self.file_end
+        else:
+            result["output_size"] = (
+                self._metadata_size
+                + result["kept_bytes"]
+                + self.file_end
+                - packpos
+            )
+        result["reclaimed_bytes"] = self.file_end - result["output_size"]
+        result["seconds"] = index_seconds + seconds_per_byte * (
+            total_bytes + self.file_end - packpos
+        )
+        logging.info("estimate %r", result)
+        return result
+
     def copyToPacktime(self, packpos, index, output):
-        pos = new_pos = self._metadata_size
+        pos = self._metadata_size
         self._file.seek(0)
         output.write(self._file.read(self._metadata_size))
+        processes = self.copy_processes
+        if processes and processes > 1 and hasattr(os, "fork"):
+            return self.copySegments(pos, packpos, index, output, processes)
+        return self.copyRange(pos, packpos, index, output)
+
+    def copyRange(self, pos, packpos, index, output):
+        # Copy the current records in the transactions from `pos` to
+        # `packpos`, returning the new index and the output position.
+        new_pos = output.tell()
         new_index = ZODB.fsIndex.fsIndex()
         pack_blobs = self.pack_blobs
         transform = self.transform
-        untransform = self.untransform
-        if untransform is None:
-            is_blob_record = ZODB.blob.is_blob_record
-        else:
-            _is_blob_record = ZODB.blob.is_blob_record
-
-            def is_blob_record(data):
-                return _is_blob_record(untransform(data))
+        is_blob_record = self._blobRecordTest()
+        report = self.report
+        garbage = self.garbage
+        backpointers = self.backpointers
+        dedup = self.dedup
+        checksums = self.checksums
+        tids = self.tids
+        archive = self.archive
+        budget = self.budget
 
         log_pos = pos
+        control = self.control
 
         while pos < packpos:
+            if budget is not None and budget.spent(pos):
+                break
+            if control is not None:
+                control.check("copy to pack time", pos, packpos)
             start_time = time.time()
             th = self._read_txn_header(pos)
-            new_tpos = 0
+            archiving = archive is not None and archive.begin(th)
+            new_tpos = None
             tend = pos + th.tlen
+            if report is not None:
+                report.transaction(th.tlen)
             pos += th.headerlen()
             while pos < tend:
                 h = self._read_data_header(pos)
                 if index.get(h.oid) != pos:
                     pos += h.recordlen()
-                    if pack_blobs:
+                    if pack_blobs or report is not None or archiving:
                         if h.plen:
                             data = self._file.read(h.plen)
                         else:
                             data = self.fetchDataViaBackpointer(h.oid, h.back)
-                        if data and is_blob_record(data):
+                        if archiving:
+                            archive.store(
+                                h.oid,
+                                h.tid,
+                                data,
+                                bool(pack_blobs and data and is_blob_record(data)),
+                            )
+                        if report is not None:
+                            report.record(h.oid, data, h.recordlen(), False)
+                        if pack_blobs and data and is_blob_record(data):
                             # We need to remove the blob record. Maybe we
                             # need to remove oid.
 
@@ -490,15 +2101,18 @@ class PackProcess(FileStoragePacker):
                                 self.blob_removed.write(
                                     binascii.hexlify(h.oid + h.tid) + b"\n"
                                 )
+                            if garbage is not None and h.oid in garbage:
+                                self.garbage_blobs.add(h.oid)
 
                     continue
 
+                record_pos = pos
                 pos += h.recordlen()
 
                 # If we are going to copy any data, we need to copy
                 # the transaction header.  Note that we will need to
                 # patch up the transaction length when we are done.
-                if not new_tpos:
+                if new_tpos is None:
                     th.status = "p"
                     new_tpos = output.tell()
                     output.write(th.asString())
@@ -511,14 +2125,33 @@ class PackProcess(FileStoragePacker):
                     # to write the data in the new record.
                     data = self.fetchBackpointer(h.oid, h.back) or b""
 
+                if archiving:
+                    archive.store(
+                        h.oid,
+                        h.tid,
+                        data or None,
+                        bool(pack_blobs and data and is_blob_record(data)),
+                    )
+
                 if transform is not None:
                     data = self.transform(data)
 
+                if report is not None:
+                    report.record(h.oid, data, DATA_HDR_LEN + (len(data) or 8), True)
+
                 h.prev = 0
                 h.back = 0
                 h.plen = len(data)
                 h.tloc = new_tpos
-                new_index[h.oid] = output.tell()
+                here = output.tell()
+                new_index[h.oid] = here
+                if data and backpointers is not None:
+                    key = p64(record_pos)
+                    if key in backpointers:
+                        backpointers[key] = here
+                if data and dedup is not None:
+                    # Later revisions may repeat what we keep.
+                    dedup.remember(h.oid, dedup.digest(data), here)
                 output.write(h.asString())
                 output.write(data)
                 if not data:
@@ -527,7 +2160,10 @@ class PackProcess(FileStoragePacker):
                     # This is a George Bailey event.
                     output.write(z64)
 
-            if new_tpos:
+            if archiving:
+                archive.finish()
+
+            if new_tpos is not None:
                 new_pos = output.tell()
                 tlen = p64(new_pos - new_tpos)
                 output.write(tlen)
@@ -539,6 +2175,11 @@ class PackProcess(FileStoragePacker):
                     output.write(tlen)
                     output.seek(new_pos)
 
+                if checksums is not None:
+                    checksums.transaction(output, new_tpos, new_pos)
+                if tids is not None:
+                    tids.add(th.tid, new_tpos)
+
                 self._freeoutputcache(new_pos)
 
             pos += 8
@@ -551,6 +2192,141 @@ class PackProcess(FileStoragePacker):
 
         return new_index, new_pos
 
+    def copySegments(self, pos, packpos, index, output, processes):
+        """Copy to the pack time using several processes
+
+        The transactions to the pack time are divided into segments,
+        which are copied to separate files in parallel.  The segments
+        are then patched for their positions in the output and copied
+        into it, also in parallel.  The output is the same as when
+        copying serially.  Pause, resume and cancel commands are
+        honoured as segments are finished.
+        """
+        global _copying
+        import zc.FileStorage.verify
+
+        verifier = zc.FileStorage.verify.Verifier(self._name)
+        try:
+            chunks = verifier.chunks(pos, packpos, processes * 4)
+        finally:
+            verifier.close()
+        segment_path = output.name + ".segment%s"
+        chunks = [
+            (start, end, segment_path % i) for i, (start, end, _) in enumerate(chunks)
+        ]
+        logging.info("copying %s segments with %s processes", len(chunks), processes)
+
+        new_index = ZODB.fsIndex.fsIndex()
+        backpointers = self.backpointers
+        control = self.control
+        placements = []
+        new_pos = pos
+        output.flush()
+        # Pool processes would write anything still buffered again
+        # when they drop their copies.
+        if self.checksums is not None:
+            self.checksums.file.flush()
+        if self.tids is not None:
+            self.tids.file.flush()
+        if self.pack_blobs:
+            self.blob_removed.flush()
+        _copying = self, index
+        pool = multiprocessing.Pool(processes)
+        try:
+            try:
+                # As segments are copied, we learn where they go.
+                results = pool.imap(_copySegment, chunks)
+                for (start, end, path), result in zip(chunks, results):
+                    (
+                        segment_index,
+                        size,
+                        removed,
+                        garbage_blobs,
+                        targets,
+                        digests,
+                    ) = result
+                    if control is not None:
+                        control.check("copy to pack time", end, packpos)
+                    for oid, segment_pos in segment_index.iteritems():
+                        new_index[oid] = new_pos + segment_pos
+                    for key, segment_pos in targets:
+                        backpointers[key] = new_pos + segment_pos
+                    for oid, (digest, segment_pos) in digests:
+                        self.dedup.remember(oid, digest, new_pos + segment_pos)
+                    if removed:
+                        self.blob_removed.write(removed)
+                    self.garbage_blobs.update(garbage_blobs)
+                    placements.append((path, output.name, new_pos))
+                    new_pos += size
+
+                pool.map(_placeSegment, placements)
+            except Exception:
+                pool.terminate()
+                for _, _, path in chunks:
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise
+        finally:
+            pool.close()
+            pool.join()
+            _copying = None
+
+        if self.checksums is not None or self.tids is not None:
+            tpos = pos
+            while tpos < new_pos:
+                output.seek(tpos)
+                tid = output.read(8)
+                tend = tpos + u64(output.read(8)) + 8
+                if self.checksums is not None:
+                    self.checksums.transaction(output, tpos, tend)
+                if self.tids is not None:
+                    self.tids.add(tid, tpos)
+                tpos = tend
+        output.seek(new_pos)
+        self._freeoutputcache(new_pos)
+        return new_index, new_pos
+
+    def copySegment(self, start, end, path, index):
+        # Copy a segment in a pool process, returning its index, with
+        # positions relative to its start, its size, removed blob
+        # records, garbage blob oids, the relative positions of
+        # copied backpointer targets and the digests and relative
+        # positions of the records remembered to find duplicates.
+
+        # We share the parent's input file position, so we need our
+        # own file.
+        self._file = self._openInput()
+        self._freecache = _freefunc(self._file)
+        self.control = self.checksums = self.tids = None
+        self.blob_removed = io.BytesIO()
+        self.garbage_blobs = set()
+        if self.dedup is not None:
+            self.dedup.records.clear()
+        try:
+            with open(path, "w+b") as output:
+                self._freeoutputcache = _freefunc(output)
+                segment_index, size = self.copyRange(start, end, index, output)
+        finally:
+            self._file.close()
+
+        targets = []
+        if self.backpointers is not None:
+            # Targets were unmapped when we were forked, so any in the
+            # segment that are mapped now were copied by us.
+            targets = [
+                (k, v)
+                for (k, v) in self.backpointers.iteritems()
+                if v and start <= u64(k) < end
+            ]
+        return (
+            segment_index,
+            size,
+            self.blob_removed.getvalue(),
+            self.garbage_blobs,
+            targets,
+            list(self.dedup.records.items()) if self.dedup is not None else [],
+        )
+
     def fetchDataViaBackpointer(self, oid, back):
         """Return the data for oid via backpointer back
 
@@ -566,7 +2342,10 @@ class PackProcess(FileStoragePacker):
     def copyFromPacktime(self, pos, file_end, output, index):
 
         log_pos = pos
+        control = self.control
         while pos < file_end:
+            if control is not None:
+                control.check("copy from pack time", pos, file_end)
             start_time = time.time()
             pos = self._copyNewTrans(pos, output, index)
             self._freeoutputcache(output.tell())
@@ -579,17 +2358,309 @@ class PackProcess(FileStoragePacker):
         return pos
 
 
+class PackReport(object):
+    """Statistics about the records before the pack time
+
+    Records kept and dropped are counted, along with their bytes, by
+    the class of the object they hold.  Kept bytes are the bytes
+    written to the packed file.  Revisions are counted per oid to find
+    the most revised objects.  To bound memory, at most `capacity`
+    oids are tracked, and when there are more, counts are reduced, as
+    in the Misra-Gries frequent-items algorithm, so that the most
+    revised objects are still found, but their counts are lower
+    bounds.  Transaction sizes are counted in powers of 2.
+    """
+
+    top = 20
+
+    def __init__(self, top=top, untransform=None, capacity=None):
+        self.top = top
+        self.untransform = untransform
+        self.capacity = capacity or max(top * 50, 1000)
+        self.classes = {}  # {class name -> [kept, kept bytes, dropped, dropped bytes]}
+        self.revisions = {}  # {oid -> revision count}
+        self.transaction_sizes = {}  # {power of 2 -> count}
+
+    def class_name(self, data):
+        if not data:
+            return "(no data)"
+        try:
+            if self.untransform is not None:
+                data = self.untransform(data)
+            module, name = ZODB.utils.get_pickle_metadata(data)
+        except Exception:
+            return "(unknown)"
+        if module and name:
+            return "%s.%s" % (module, name)
+        return module or name or "(unknown)"
+
+    def record(self, oid, data, size, kept):
+        name = self.class_name(data)
+        stats = self.classes.get(name)
+        if stats is None:
+            stats = self.classes[name] = [0, 0, 0, 0]
+        i = 0 if kept else 2
+        stats[i] += 1
+        stats[i + 1] += size
+
+        revisions = self.revisions
+        revisions[oid] = revisions.get(oid, 0) + 1
+        if len(revisions) > self.capacity:
+            least = min(revisions.values())
+            for oid, count in list(revisions.items()):
+                if count == least:
+                    del revisions[oid]
+                else:
+                    revisions[oid] = count - least
+
+    def transaction(self, tlen):
+        size = 1
+        while size < tlen:
+            size <<= 1
+        self.transaction_sizes[size] = self.transaction_sizes.get(size, 0) + 1
+
+    def write(self, f):
+        f.write(
+            "%-50s %10s %14s %10s %14s\n"
+            % ("class", "kept", "kept bytes", "dropped", "dropped bytes")
+        )
+        for name, stats in sorted(
+            self.classes.items(), key=lambda item: (-item[1][3], item[0])
+        ):
+            f.write("%-50s %10d %14d %10d %14d\n" % ((name,) + tuple(stats)))
+
+        f.write("\n%-20s %10s\n" % ("oid", "revisions"))
+        for oid, count in sorted(
+            self.revisions.items(), key=lambda item: (-item[1], item[0])
+        )[: self.top]:
+            f.write("0x%-18x %10d\n" % (u64(oid), count))
+
+        f.write("\n%-20s %10s\n" % ("transaction size <=", "count"))
+        for size, count in sorted(self.transaction_sizes.items()):
+            f.write("%-20d %10d\n" % (size, count))
+
+
+garbage_bitmap_magic = b"ZCGB"
+
+
+class GarbageBitmap(object):
+    """A set of oids stored as a bitmap, with a bit for each oid up to
+    the largest
+
+    Bit ``oid % 8`` of byte ``oid // 8`` is set for each oid in the
+    set.  When most oids below the largest are allocated, as is usual
+    in a FileStorage, this uses far less memory than a set.
+    """
+
+    def __init__(self, bits=b""):
+        self.bits = bytearray(bits)
+
+    @classmethod
+    def fromOids(cls, oids):
+        bitmap = cls()
+        bits = bitmap.bits
+        for oid in oids:
+            n = u64(oid)
+            byte = n >> 3
+            if byte >= len(bits):
+                bits.extend(b"\0" * (byte + 1 - len(bits)))
+            bits[byte] |= 1 << (n & 7)
+        return bitmap
+
+    def __contains__(self, oid):
+        n = u64(oid)
+        byte = n >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (n & 7)))
+
+    def __iter__(self):
+        for byte, value in enumerate(self.bits):
+            if value:
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield p64((byte << 3) + bit)
+
+    def __len__(self):
+        return sum(bin(value).count("1") for value in self.bits)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(garbage_bitmap_magic)
+            f.write(self.bits)
+
+
+def load_garbage(path):
+    """Load a set of garbage oids from a file
+
+    The file is either a bitmap saved by GarbageBitmap, or text with
+    an oid per line, as a decimal integer or as hex with a leading
+    "0x".  Blank lines and lines starting with "#" are ignored.  Oids
+    read from text are kept in an fsIndex, which stores them compactly.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(garbage_bitmap_magic)) == garbage_bitmap_magic:
+            return GarbageBitmap(f.read())
+        f.seek(0)
+        garbage = ZODB.fsIndex.fsIndex()
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(b"#"):
+                continue
+            if line[:2].lower() == b"0x":
+                oid = int(line[2:], 16)
+            else:
+                oid = int(line)
+            garbage[p64(oid)] = 0
+        return garbage
+
+
+def max_rss():
+    """Return the peak resident set size of this process in KB, or
+    None if it can't be determined
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024  # bytes
+    return rss
+
+
+def free_space(path):
+    """Return the number of bytes available in the file system
+    containing `path`, or None if it can't be determined
+    """
+    try:
+        st = os.statvfs(path)
+    except (AttributeError, OSError):
+        return None
+    return st.f_bavail * st.f_frsize
+
+
+# Packed output can be bigger than the file packed, since backpointers
+# to records before the pack time are replaced by the data they point
+# to, so space checks allow for this much more.
+pack_space_headroom = 0.25
+
+
+def pack_space_needed(size):
+    """Return the space to require for packing a file of `size` bytes
+    """
+    return size + int(size * pack_space_headroom)
+
+
+def check_free_space(path, needed):
+    """Raise FileStorageQuotaError unless `needed` bytes are available
+    in the file system containing `path`
+    """
+    available = free_space(path)
+    if available is not None and available < needed:
+        raise FileStorageQuotaError(
+            "%s bytes are needed in %s, but only %s are available"
+            % (needed, path, available)
+        )
+
+
+def preallocate(f, size):
+    """Reserve `size` bytes of disk space for a file, extending it
+    if necessary
+
+    Returns whether the space was reserved.
+    """
+    fallocate = getattr(os, "posix_fallocate", None)
+    if fallocate is None:
+        try:
+            from ._zc_FileStorage_posix_fadvise import allocate
+        except ImportError:
+            return False
+
+        def fallocate(fd, offset, length):
+            err = allocate(fd, offset, length)
+            if err:
+                raise OSError(err, os.strerror(err))
+
+    try:
+        fallocate(f.fileno(), 0, size)
+    except OSError as v:
+        logging.info("couldn't preallocate %s bytes: %s", size, v)
+        return False
+    logging.info("preallocated %s bytes", size)
+    return True
+
+
+def copy_file(input, output):
+    """Copy the rest of the `input` file to `output`
+
+    ``os.copy_file_range`` is used where available, so the kernel can
+    copy the data without passing it through user space.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is not None:
+        input.flush()
+        output.flush()
+        size = os.fstat(input.fileno()).st_size
+        pos, out_pos = input.tell(), output.tell()
+        try:
+            while pos < size:
+                n = copy_file_range(
+                    input.fileno(), output.fileno(), size - pos, pos, out_pos
+                )
+                if not n:
+                    break
+                pos += n
+                out_pos += n
+        except OSError as v:
+            if v.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL):
+                raise
+        input.seek(pos)
+        output.seek(out_pos)
+    shutil.copyfileobj(input, output, 1 << 20)
+
+
+def move_file(src, dest):
+    """Move a file, copying it if it's on another file system
+
+    Copies are synced before the original is removed.
+    """
+    try:
+        os.rename(src, dest)
+        return
+    except OSError as v:
+        if v.errno != errno.EXDEV:
+            raise
+    with open(src, "rb") as input:
+        with open(dest, "wb") as output:
+            copy_file(input, output)
+            output.flush()
+            os.fsync(output.fileno())
+    os.remove(src)
+
+
+def remove_output(path):
+    # Remove a packed file and the sidecar files written with it.
+    for suffix in "", ".checksums", ".tids":
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
 def getglobal(s):
     module, expr = s.split(":", 1)
     return eval(expr, __import__(module, {}, {}, ["*"]).__dict__)
 
 
 def _freefunc(f):
-    # Return an posix_fadvise-based cache freeer.
+    # Return an posix_fadvise-based cache freeer.  Pages of mapped
+    # files are released with madvise too, as they aren't dropped from
+    # the cache while mapped.
 
     try:
         from . import _zc_FileStorage_posix_fadvise
     except ImportError:
+        _zc_FileStorage_posix_fadvise = None
+
+    dontneed = getattr(f, "dontneed", None)
+    if _zc_FileStorage_posix_fadvise is None and dontneed is None:
         return lambda pos: None
 
     fd = f.fileno()
@@ -602,8 +2673,14 @@ def _freefunc(f):
             return
 
         last[0] = pos
-        _zc_FileStorage_posix_fadvise.advise(
-            fd, 0, last[0] - 10000, _zc_FileStorage_posix_fadvise.POSIX_FADV_DONTNEED
-        )
+        if dontneed is not None:
+            dontneed(last[0] - 10000)
+        if _zc_FileStorage_posix_fadvise is not None:
+            _zc_FileStorage_posix_fadvise.advise(
+                fd,
+                0,
+                last[0] - 10000,
+                _zc_FileStorage_posix_fadvise.POSIX_FADV_DONTNEED,
+            )
 
     return _free
@@ -31,8 +31,20 @@ py_posix_fadvise(PyObject *self, PyObject *args)
   return PyInt_FromLong(posix_fadvise(fd, offset, len, advice));
 }
 
+static PyObject *
+py_posix_fallocate(PyObject *self, PyObject *args)
+{
+  int fd;
+  long long offset, len;
+
+  if (! PyArg_ParseTuple(args, "iLL", &fd, &offset, &len))
+    return NULL;
+  return PyInt_FromLong(posix_fallocate(fd, offset, len));
+}
+
 static struct PyMethodDef m_methods[] = {
   {"advise", (PyCFunction)py_posix_fadvise, METH_VARARGS, ""},
+  {"allocate", (PyCFunction)py_posix_fallocate, METH_VARARGS, ""},
   
   {NULL,	 (PyCFunction)NULL, 0, NULL}		/* sentinel */
 };
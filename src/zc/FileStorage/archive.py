@@ -0,0 +1,111 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Archiving history as it's packed away
+
+When packing with an archive, transactions before the pack time are
+written to an archive file storage as they're read, with all of their
+records and their metadata, including records that are dropped from
+the packed file.  Transactions already in the archive, because they
+were archived by an earlier pack, are skipped, so each transaction is
+archived once and the archive only grows by the history between pack
+times.  The archive is an ordinary file storage, so history can be
+loaded from it by opening it read only, with ``loadSerial`` or
+``loadBefore``.
+
+If the storage being packed has blobs, the blob files are copied to a
+blob directory next to the archive, with ".blobs" appended to its
+name.
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+
+from ZODB.BaseStorage import TransactionRecord
+from zodbpickle import pickle
+
+import ZODB.blob
+import ZODB.FileStorage
+
+
+class Archive(object):
+    """Write transactions to an archive file storage
+    """
+
+    def __init__(self, path, blob_dir=None):
+        if blob_dir:
+            self.blobs = ZODB.blob.FilesystemHelper(blob_dir)
+            archive_blob_dir = path + ".blobs"
+        else:
+            self.blobs = archive_blob_dir = None
+        self.storage = ZODB.FileStorage.FileStorage(path, blob_dir=archive_blob_dir)
+        self.tid = self.storage.lastTransaction()
+        self.transaction = None
+        self.transactions = self.records = 0
+
+    def begin(self, th):
+        """Start archiving the transaction with the given header
+
+        Returns whether it should be archived, because it's after the
+        last transaction in the archive.
+        """
+        if th.tid <= self.tid:
+            return False
+        if th.ext:
+            extension = pickle.loads(th.ext)
+        else:
+            extension = {}
+        self.transaction = TransactionRecord(
+            th.tid, th.status, th.user, th.descr, extension
+        )
+        self.storage.tpc_begin(self.transaction, th.tid, th.status)
+        return True
+
+    def store(self, oid, tid, data, blob=False):
+        """Archive a record of the current transaction
+
+        `data` is None for records undoing object creation.  If `blob`
+        is true, the record's blob file is archived too, if it still
+        exists.
+        """
+        if blob and self.blobs is not None:
+            path = self.blobs.getBlobFilename(oid, tid)
+            if os.path.exists(path):
+                # Blobs are moved into the archive, so give it a copy.
+                copy = os.path.join(
+                    self.storage.temporaryDirectory(), os.path.basename(path)
+                )
+                shutil.copyfile(path, copy)
+                self.storage.restoreBlob(oid, tid, data, copy, None, self.transaction)
+                self.records += 1
+                return
+        self.storage.restore(oid, tid, data, "", None, self.transaction)
+        self.records += 1
+
+    def finish(self):
+        """Commit the current transaction
+        """
+        transaction = self.transaction
+        self.storage.tpc_vote(transaction)
+        self.storage.tpc_finish(transaction)
+        self.tid = transaction.tid
+        self.transaction = None
+        self.transactions += 1
+
+    def close(self):
+        if self.transaction is not None:
+            self.storage.tpc_abort(self.transaction)
+            self.transaction = None
+        self.storage.close()
@@ -0,0 +1,229 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Data record checksums
+
+When packing with checksums, a CRC-32 of each data record written,
+header and data, is saved in a checksums file next to the packed
+file.  The file starts with a 4-byte magic number and the id and
+position, as an 8-byte unsigned integer, of the last transaction
+covered.  That's followed by a 12-byte entry for each record, giving
+the record's position, as an 8-byte unsigned integer, and its
+checksum, as a 4-byte unsigned integer.  Entries are in file order.
+
+Records written after the pack aren't covered.  A checksums file is
+only used if the transaction it ends with matches the file, so
+checksums left describing another file, such as a packed file that
+didn't replace the storage's, aren't mistaken for corruption.
+"""
+
+from __future__ import print_function
+
+import getopt
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+
+from ZODB.FileStorage.format import DATA_HDR_LEN, TRANS_HDR_LEN
+from ZODB.FileStorage.format import DataHeaderFromString, TxnHeaderFromString
+from ZODB.utils import p64, u64, z64
+
+magic = b"ZCCS"
+header_size = len(magic) + 16
+entry = struct.Struct(">QI")
+
+
+def checksum(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def read_record(f, pos):
+    """Read the data record at `pos`, returning its bytes
+    """
+    f.seek(pos)
+    header = f.read(DATA_HDR_LEN)
+    if len(header) < DATA_HDR_LEN:
+        return header
+    h = DataHeaderFromString(header)
+    return header + f.read(h.recordlen() - DATA_HDR_LEN)
+
+
+class ChecksumWriter(object):
+    """Write checksums for the records of transactions in a file
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        if append and os.path.exists(path):
+            self.file = open(path, "r+b")
+            self.file.seek(0, 2)
+        else:
+            self.file = open(path, "wb")
+            self.file.write(magic + z64 + p64(0))
+        self.records = 0
+        self.last = None
+
+    def transaction(self, f, tpos, tend):
+        """Add checksums for the data records of the transaction
+        written to `f` from `tpos` up to `tend`
+
+        The records are read back, so they're checksummed as written.
+        The file is left positioned at `tend`.
+        """
+        f.seek(tpos)
+        th = TxnHeaderFromString(f.read(TRANS_HDR_LEN))
+        pos = tpos + th.headerlen()
+        end = tend - 8
+        write = self.file.write
+        while pos < end:
+            record = read_record(f, pos)
+            if len(record) < DATA_HDR_LEN:
+                raise ValueError("Truncated data record at %s" % pos)
+            write(entry.pack(pos, checksum(record)))
+            self.records += 1
+            pos += len(record)
+        f.seek(tend)
+        self.last = th.tid, tpos
+
+    def close(self):
+        if self.last is not None:
+            tid, tpos = self.last
+            self.file.seek(len(magic))
+            self.file.write(tid + p64(tpos))
+        self.file.close()
+
+
+def entries(path):
+    """Return the number of entries in a checksums file
+    """
+    return (os.path.getsize(path) - header_size) // entry.size
+
+
+def matches(path, checksums_path):
+    """Return whether the transaction a checksums file ends with
+    matches the file
+    """
+    with open(checksums_path, "rb") as checksums:
+        checksums.seek(len(magic))
+        data = checksums.read(16)
+    tid, tpos = data[:8], u64(data[8:])
+    if tid == z64:
+        return True  # No transactions are covered.
+    with open(path, "rb") as f:
+        f.seek(tpos)
+        header = f.read(TRANS_HDR_LEN)
+    if len(header) < TRANS_HDR_LEN:
+        return False
+    return TxnHeaderFromString(header).tid == tid
+
+
+def _scrub(args):
+    path, checksums_path, start, end = args
+    bad = []
+    with open(path, "rb") as f:
+        with open(checksums_path, "rb") as checksums:
+            checksums.seek(header_size + start * entry.size)
+            for i in range(start, end):
+                pos, expected = entry.unpack(checksums.read(entry.size))
+                try:
+                    record = read_record(f, pos)
+                except Exception:
+                    bad.append((pos, "unreadable"))
+                    continue
+                if len(record) < DATA_HDR_LEN:
+                    bad.append((pos, "truncated"))
+                elif checksum(record) != expected:
+                    bad.append((pos, "checksum mismatch"))
+    return bad
+
+
+def scrub(path, checksums_path=None, processes=None):
+    """Verify the records of a file against its checksums
+
+    The entries are divided among `processes` processes, which default
+    to the number of CPUs.  A list of bad records is returned, as
+    position and problem pairs, along with the number of records
+    checked.
+    """
+    if checksums_path is None:
+        checksums_path = path + ".checksums"
+    with open(checksums_path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("%s isn't a checksums file" % checksums_path)
+    if not matches(path, checksums_path):
+        raise ValueError("%s doesn't match %s" % (checksums_path, path))
+    n = entries(checksums_path)
+    processes = processes or multiprocessing.cpu_count()
+    chunk = max(1, -(-n // (processes * 4)))
+    chunks = [
+        (path, checksums_path, start, min(start + chunk, n))
+        for start in range(0, n, chunk)
+    ]
+    if processes == 1 or len(chunks) < 2:
+        results = [_scrub(args) for args in chunks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_scrub, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    return [b for result in results for b in result], n
+
+
+usage = """Usage: %s [options] path
+
+Verify the data records of a file storage against the checksums
+written when it was packed with checksums.
+
+Options:
+
+  -c, --checksums PATH
+      The checksums file.  This defaults to the storage path with
+      ".checksums" appended.
+
+  -p, --processes N
+      The number of processes to use.  This defaults to the number of
+      CPUs.
+"""
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    try:
+        options, args = getopt.getopt(args, "c:p:", ["checksums=", "processes="])
+        checksums_path = processes = None
+        for name, value in options:
+            if name in ("-c", "--checksums"):
+                checksums_path = value
+            else:
+                processes = int(value)
+        [path] = args
+    except (getopt.GetoptError, ValueError):
+        print(usage % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        bad, n = scrub(path, checksums_path, processes)
+    except ValueError as v:
+        print(v, file=sys.stderr)
+        sys.exit(1)
+    for pos, problem in bad:
+        print(pos, problem)
+    print("checked %s records, %s bad" % (n, len(bad)))
+    if bad:
+        sys.exit(1)
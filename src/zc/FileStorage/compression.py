@@ -0,0 +1,83 @@
+##############################################################################
+#
+# Copyright (c) 2005 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compression for pack transforms
+
+Records are compressed with zlib and given a ".z" prefix, as by
+zc.zlibstorage, so packed storages can be opened with it.
+
+Pickles never start with ".", so records starting with "." have
+already been compressed, or otherwise transformed, and are left
+alone, as are records that don't get smaller.  Records are
+decompressed with `decompress`.
+"""
+
+from __future__ import absolute_import
+
+import time
+import zlib
+
+_cpu_time = getattr(time, "process_time", None) or time.clock
+
+
+class Compressor(object):
+    """Compress records with zlib, keeping statistics
+    """
+
+    level = 9
+
+    def __init__(self, level=None):
+        if level is not None:
+            self.level = level
+        self.records = self.compressed = 0
+        self.input_bytes = self.output_bytes = 0
+        self.seconds = 0.0
+
+    def compress(self, data):
+        self.records += 1
+        self.input_bytes += len(data)
+        if data[:1] != b".":
+            start = _cpu_time()
+            compressed = b".z" + zlib.compress(data, self.level)
+            self.seconds += _cpu_time() - start
+            if len(compressed) < len(data):
+                self.compressed += 1
+                data = compressed
+        self.output_bytes += len(data)
+        return data
+
+    def stats(self):
+        if self.input_bytes:
+            ratio = 100.0 * self.output_bytes / self.input_bytes
+        else:
+            ratio = 100.0
+        return (
+            "zlib compressed %s of %s records, %s to %s bytes (%.1f%%), "
+            "%.2f CPU seconds"
+            % (
+                self.compressed,
+                self.records,
+                self.input_bytes,
+                self.output_bytes,
+                ratio,
+                self.seconds,
+            )
+        )
+
+
+def decompress(data):
+    """Decompress a record compressed by a `Compressor`
+    """
+    if data[:2] == b".z":
+        return zlib.decompress(data[2:])
+    return data
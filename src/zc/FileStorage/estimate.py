@@ -0,0 +1,110 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+from __future__ import print_function
+
+import getopt
+import os
+import sys
+import time
+import zc.FileStorage
+import zc.FileStorage.snapshotintime
+import ZODB.TimeStamp
+
+usage = """Usage: %s [options] input-path [utc-pack-time]
+
+Estimate the effect of packing a file-storage data file to the given
+time without writing anything.  The expected output size, the number
+of records and bytes kept and dropped and the time the pack will take
+are printed.
+
+If the utc-pack-time is ommitted, then the current time will be used.
+
+The UTC time is a string of the form: YYYY-MM-DDTHH:MM:SS.  The time
+conponents are optional.  The time defaults to midnight, UTC.
+
+Options:
+
+  -d, --days DAYS
+      Pack to the given number of days before now.
+
+  -s, --sample FRACTION
+      Examine the given fraction of the transactions before the pack
+      time and scale up the results.  This defaults to 1.
+
+  -b, --blobs
+      Count the blob revisions that would be removed.
+"""
+
+report_template = """\
+pack time:              %(pack_time)s
+input size:             %(input_size)s
+output size:            %(output_size)s
+reclaimed bytes:        %(reclaimed_bytes)s
+objects:                %(objects)s
+kept records:           %(kept_records)s
+kept bytes:             %(kept_bytes)s
+dropped records:        %(dropped_records)s
+dropped bytes:          %(dropped_bytes)s
+blob revisions removed: %(blob_revisions_removed)s
+sample:                 %(sample)s
+estimated seconds:      %(seconds).1f\
+"""
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    try:
+        options, args = getopt.getopt(
+            args, "d:s:b", ["days=", "sample=", "blobs"]
+        )
+        days = None
+        sample = 1.0
+        blobs = False
+        for name, value in options:
+            if name in ("-d", "--days"):
+                days = float(value)
+            elif name in ("-s", "--sample"):
+                sample = float(value)
+                if not 0 < sample <= 1:
+                    raise ValueError(value)
+            else:
+                blobs = True
+        inpath, stop = (args + [None])[:2]
+        if not args or len(args) > 2 or (days is not None and stop is not None):
+            raise ValueError(args)
+    except (getopt.GetoptError, ValueError):
+        print(usage % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+
+    if not os.path.exists(inpath):
+        print(inpath, "Does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+    if stop is None:
+        t = time.time() - (days or 0) * 86400
+        stop = ZODB.TimeStamp.TimeStamp(*time.gmtime(t)[:5] + (t % 60,)).raw()
+    else:
+        try:
+            stop = zc.FileStorage.snapshotintime.parse_time(stop)
+        except Exception:
+            print("Bad date-time:", stop, file=sys.stderr)
+            sys.exit(1)
+
+    result = zc.FileStorage.PackProcess(
+        inpath, stop, os.stat(inpath).st_size
+    ).estimate(sample, blobs)
+    print(report_template % dict(result, pack_time=ZODB.TimeStamp.TimeStamp(stop)))
@@ -0,0 +1,153 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Frozen file storages
+
+A snapshot made with --frozen-index gets an oids file, next to it, in
+addition to its pickled index.  The file starts with a 4-byte magic
+number and the 8-byte position of the end of the snapshot, followed by
+a 16-byte entry for each object, giving its oid and the position of
+its current record, in oid order.
+
+``FrozenFileStorage`` is a read-only file storage that memory maps the
+oids file and searches it as objects are loaded, rather than loading
+the whole index when it's opened, so large snapshots open immediately
+and processes using the same snapshot, such as test runners using it
+as the base of a ``DemoStorage``, share the index through the page
+cache.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+
+from ZODB.utils import p64, u64
+
+import ZODB.FileStorage
+
+logger = logging.getLogger(__name__)
+
+magic = b"ZCOI"
+header_size = 12
+entry_size = 16
+
+
+def save(index, pos, path):
+    """Save an index, for a file ending at `pos`, to an oids file
+    """
+    with open(path, "wb") as f:
+        f.write(magic + p64(pos))
+        # fsIndex iterates in oid order.
+        for oid, opos in index.iteritems():
+            f.write(oid + p64(opos))
+
+
+class FrozenIndex(object):
+    """A read-only index searching a memory-mapped oids file
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError("%s isn't an oids file" % path)
+            self.pos = u64(f.read(8))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = (len(self.map) - header_size) // entry_size
+
+    def __len__(self):
+        return self.size
+
+    def _oid(self, i):
+        start = header_size + i * entry_size
+        return self.map[start : start + 8]
+
+    def _search(self, oid):
+        # Return the index of the first entry with an oid at or after
+        # `oid`.
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if self._oid(mid) < oid:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def get(self, oid, default=None):
+        i = self._search(oid)
+        if i < self.size and self._oid(i) == oid:
+            start = header_size + i * entry_size + 8
+            return u64(self.map[start : start + 8])
+        return default
+
+    def __getitem__(self, oid):
+        pos = self.get(oid)
+        if pos is None:
+            raise KeyError(oid)
+        return pos
+
+    def __contains__(self, oid):
+        return self.get(oid) is not None
+
+    def minKey(self, key=None):
+        i = 0 if key is None else self._search(key)
+        if i >= self.size:
+            raise ValueError("empty tree")
+        return self._oid(i)
+
+    def maxKey(self):
+        if not self.size:
+            raise ValueError("empty tree")
+        return self._oid(self.size - 1)
+
+    def iteritems(self):
+        for i in range(self.size):
+            start = header_size + i * entry_size
+            yield self.map[start : start + 8], u64(self.map[start + 8 : start + 16])
+
+    def close(self):
+        self.map.close()
+
+
+class FrozenFileStorage(ZODB.FileStorage.FileStorage):
+    """A read-only file storage using a frozen index, if it has one
+
+    If the oids file is missing, or doesn't match the data file, the
+    index is loaded or built as usual.
+    """
+
+    def __init__(self, file_name, blob_dir=None):
+        ZODB.FileStorage.FileStorage.__init__(
+            self, file_name, read_only=True, blob_dir=blob_dir
+        )
+
+    def _restore_index(self):
+        index_name = self.__name__ + ".oids"
+        if os.path.exists(index_name):
+            index = FrozenIndex(index_name)
+            self._file.seek(0, 2)
+            if self._file.tell() == index.pos:
+                tid = self._sane(index, index.pos)
+                if tid:
+                    return index, index.pos, tid
+            else:
+                logger.warning("Ignoring changed %s", index_name)
+            index.close()
+        return ZODB.FileStorage.FileStorage._restore_index(self)
+
+    def close(self):
+        ZODB.FileStorage.FileStorage.close(self)
+        if isinstance(self._index, FrozenIndex):
+            self._index.close()
@@ -0,0 +1,74 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Saving the progress of budgeted packs
+
+When a pack with a time or byte budget spends it before reaching the
+pack time, the output written so far is kept and its progress is
+saved, so the next pack can pick up where it stopped.  The progress
+is saved in a ``.packstate`` file next to the storage, with the index
+of current records at the pack time, the index of the records copied
+so far and the records pointed to by backpointers after the pack time
+in ``.packstate.index``, ``.packstate.copied`` and
+``.packstate.targets``.  The ``.packstate`` file is written last, so
+the state is only used if it was completely saved.
+"""
+
+from __future__ import absolute_import
+
+import os
+
+from zodbpickle import pickle
+
+import ZODB.fsIndex
+
+suffixes = (
+    ".packstate",
+    ".packstate.index",
+    ".packstate.copied",
+    ".packstate.targets",
+)
+
+
+def save(path, state, index, copied, targets):
+    """Save the state of a pack of the storage at `path`
+
+    `state` is a dictionary of picklable values.
+    """
+    index.save(state["packpos"], path + ".packstate.index")
+    copied.save(state["opos"], path + ".packstate.copied")
+    targets.save(state["file_end"], path + ".packstate.targets")
+    with open(path + ".packstate.tmp", "wb") as f:
+        pickle.Pickler(f, 1).dump(state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".packstate.tmp", path + ".packstate")
+
+
+def load(path):
+    """Return the saved state and indexes of a pack, or None
+    """
+    if not os.path.exists(path + ".packstate"):
+        return None
+    with open(path + ".packstate", "rb") as f:
+        state = pickle.Unpickler(f).load()
+    index = ZODB.fsIndex.fsIndex.load(path + ".packstate.index")["index"]
+    copied = ZODB.fsIndex.fsIndex.load(path + ".packstate.copied")["index"]
+    targets = ZODB.fsIndex.fsIndex.load(path + ".packstate.targets")["index"]
+    return state, index, copied, targets
+
+
+def remove(path):
+    for suffix in suffixes:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
@@ -0,0 +1,237 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Scheduling packs of storages that share disks
+
+Packs of storages configured with the same scheduler directory are
+coordinated through files in it, so no separate server is needed.
+At most `slots` packs run at once.  Packs waiting for a slot are
+queued and started in order of priority, then of expected reclaim,
+then of when they were queued.  Expected reclaim is how much a storage
+has grown since it was last packed, or its size if it hasn't been
+packed with the scheduler.
+
+If a rate is given, in megabytes per second, it's divided among the
+running packs, which sleep as needed to keep to their share of it.
+
+The directory has a ``slot-N.lock`` file for each slot, and, for each
+storage, a ``.queued`` file while its pack waits, a ``.running`` file
+while it runs and a ``.packed`` file with the size of its last packed
+output.  A storage's files are named after its percent-encoded
+absolute path.  Entries left by processes that died are ignored.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import time
+
+import zc.lockfile
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+MB = 1 << 20
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class Scheduler(object):
+    """Coordinate packs through files in a directory
+    """
+
+    poll_interval = 1.0
+
+    def __init__(self, directory, slots=1, rate=None):
+        self.directory = directory
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self.slots = slots
+        self.rate = rate
+
+    def _path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    def _entries(self, suffix):
+        # Return the names and contents of the live entries with the
+        # given suffix, removing dead ones.
+        entries = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(suffix):
+                continue
+            path = os.path.join(self.directory, fname)
+            try:
+                with open(path) as f:
+                    values = f.read().split()
+                pid = int(values[0])
+            except (IOError, OSError, ValueError, IndexError):
+                continue  # Being written or removed
+            if _alive(pid):
+                entries.append((fname[: -len(suffix)], values))
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return entries
+
+    def _write(self, name, suffix, *values):
+        path = self._path(name, suffix)
+        with open(path + ".tmp", "w") as f:
+            f.write(" ".join(str(v) for v in (os.getpid(),) + values))
+        os.rename(path + ".tmp", path)
+
+    def _remove(self, name, suffix):
+        try:
+            os.remove(self._path(name, suffix))
+        except OSError:
+            pass
+
+    def name(self, path):
+        """Return the name of the entries for the storage at `path`
+        """
+        # Percent-encoding keeps names of different paths distinct.
+        return quote(os.path.abspath(path), safe="")
+
+    def expectedReclaim(self, name, size):
+        """Estimate what packing a storage of the given size would reclaim
+        """
+        try:
+            with open(self._path(name, ".packed")) as f:
+                packed = int(f.read().split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            return size
+        return max(size - packed, 0)
+
+    def queue(self):
+        """Return the names of the packs waiting, in the order they'll run
+        """
+        entries = self._entries(".queued")
+        entries.sort(key=lambda e: (-float(e[1][1]), -int(e[1][2]), float(e[1][3])))
+        return [name for (name, _) in entries]
+
+    def running(self):
+        """Return the number of packs running
+        """
+        return len(self._entries(".running"))
+
+    def acquire(self, path, size, priority=0, control=None):
+        """Wait for a slot to pack the storage at `path`
+
+        If `control` is given, it's checked while waiting, so waiting
+        packs can be cancelled.  A ``Slot`` is returned.
+        """
+        name = self.name(path)
+        reclaim = self.expectedReclaim(name, size)
+        self._write(name, ".queued", priority, reclaim, time.time())
+        logged = False
+        try:
+            while True:
+                queue = self.queue()
+                if queue and queue[0] == name:
+                    for i in range(self.slots):
+                        try:
+                            lock = zc.lockfile.LockFile(
+                                os.path.join(self.directory, "slot-%s.lock" % i)
+                            )
+                        except zc.lockfile.LockError:
+                            continue
+                        self._write(name, ".running", i)
+                        self._remove(name, ".queued")
+                        logger.info("got pack slot %s", i)
+                        return Slot(self, name, lock, control)
+                if not logged:
+                    logger.info(
+                        "waiting for a pack slot, %s packs queued", len(queue)
+                    )
+                    logged = True
+                if control is not None:
+                    control.check("waiting for a pack slot", 0, 0)
+                time.sleep(self.poll_interval)
+        except BaseException:
+            self._remove(name, ".queued")
+            raise
+
+
+class Slot(object):
+    """A slot to run a pack in
+
+    Slots are also pack controls.  Checks are passed to the pack's
+    control, if it has one, and used to keep to the pack's share of
+    the scheduler's rate, assuming that what's been read is the
+    distance from the last position checked.
+    """
+
+    window = 1.0
+
+    def __init__(self, scheduler, name, lock, control=None):
+        self.scheduler = scheduler
+        self.name = name
+        self.lock = lock
+        self.control = control
+        self.phase = None
+        self.share()
+
+    def share(self):
+        """Return our share of the rate, in bytes per second, or None
+        """
+        rate = self.scheduler.rate
+        if rate:
+            rate = rate * MB / max(self.scheduler.running(), 1)
+        else:
+            rate = None
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.rate = rate
+        return rate
+
+    def check(self, phase, pos, end):
+        if self.control is not None:
+            self.control.check(phase, pos, end)
+        if self.rate is None:
+            return
+        if phase != self.phase:
+            self.phase = phase
+            self.pos = pos
+            return
+        self.window_bytes += max(pos - self.pos, 0)
+        self.pos = pos
+        elapsed = time.time() - self.window_start
+        wait = float(self.window_bytes) / self.rate - elapsed
+        if wait > 0:
+            time.sleep(wait)
+        if elapsed >= self.window:
+            # Other packs may have started or finished.
+            self.share()
+
+    def release(self, packed_size=None):
+        if packed_size is not None:
+            self.scheduler._write(self.name, ".packed", packed_size)
+        self.scheduler._remove(self.name, ".running")
+        self.lock.close()
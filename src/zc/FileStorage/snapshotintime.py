@@ -14,12 +14,15 @@
 
 from __future__ import print_function
 
+import getopt
 import os
 import sys
 import zc.FileStorage
 import ZODB.TimeStamp
 
-usage = """Usage: %s [input-path utc-snapshot-time output-path]
+from ZODB.utils import p64, z64
+
+usage = """Usage: %s [options] [input-path utc-snapshot-time output-path]
 
 Make a point-in time snapshot of a file-storage data file containing
 just the current records as of the given time.  The resulting file can
@@ -34,13 +37,66 @@ Note: blobs (if any) aren't copied.
 
 The UTC time is a string of the form: YYYY-MM-DDTHH:MM:SS.  The time
 conponents are optional.  The time defaults to midnight, UTC.
+
+Options:
+
+  -r, --reachable
+      Only include objects reachable from the root object.
+
+  -o, --oid OID
+      Only include objects reachable from the object with the given
+      oid (an integer, use a 0x prefix for hex).  This option may be
+      given more than once and may be combined with --reachable.
+
+  -t, --tids
+      Also write a tids file, with the position of each transaction in
+      the snapshot, next to it.  See zc.FileStorage.tids.
+
+  -f, --frozen-index
+      Also write a sorted oids file, next to the snapshot, so it can be
+      opened immediately with zc.FileStorage.frozen.FrozenFileStorage.
 """
 
 
+def parse_time(stop):
+    """Convert a UTC time string, YYYY-MM-DDTHH:MM:SS, to a raw time stamp
+    """
+    date, time = (stop.split("T") + [""])[:2]
+    year, month, day = (int(x) for x in date.split("-"))
+    if time:
+        hour, minute, second = ([int(x) for x in time.split(":")] + [0, 0])[:3]
+    else:
+        hour = minute = second = 0
+    return ZODB.TimeStamp.TimeStamp(year, month, day, hour, minute, second).raw()
+
+
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
+    try:
+        options, args = getopt.getopt(
+            args, "ro:tf", ["reachable", "oid=", "tids", "frozen-index"]
+        )
+        roots = None
+        tids = frozen_index = False
+        for name, value in options:
+            if name in ("-t", "--tids"):
+                tids = True
+                continue
+            if name in ("-f", "--frozen-index"):
+                frozen_index = True
+                continue
+            if roots is None:
+                roots = []
+            if name in ("-r", "--reachable"):
+                roots.append(z64)
+            else:
+                roots.append(p64(int(value, 0)))
+    except (getopt.GetoptError, ValueError):
+        print(usage % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+
     if len(args) < 2 or len(args) > 3:
         print(usage % sys.argv[0], file=sys.stderr)
         sys.exit(1)
@@ -63,18 +119,11 @@ def main(args=None):
         sys.exit(1)
 
     try:
-        date, time = (stop.split("T") + [""])[:2]
-        year, month, day = (int(x) for x in date.split("-"))
-        if time:
-            hour, minute, second = ([int(x) for x in time.split(":")] + [0, 0])[:3]
-        else:
-            hour = minute = second = 0
-        stop = ZODB.TimeStamp.TimeStamp(year, month, day, hour, minute, second).raw()
-
+        stop = parse_time(stop)
     except Exception:
         print("Bad date-time:", stop, file=sys.stderr)
         sys.exit(1)
 
-    zc.FileStorage.PackProcess(inpath, stop, os.stat(inpath).st_size).pack(
-        snapshot_in_time_path=outpath
+    zc.FileStorage.PackProcess(inpath, stop, os.stat(inpath).st_size, tids=tids).pack(
+        snapshot_in_time_path=outpath, roots=roots, frozen_index=frozen_index
     )
@@ -0,0 +1,267 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Streaming packed files as they're written
+
+When packing with a stream, the packed file is sent, as it's written,
+to a consumer listening on a Unix socket, or reading a named pipe, so
+it can be backed up or replicated without reading it again.  Parts of
+the file are sent from a background thread once they're final, so a
+slow consumer never holds up copying, or the storage's commit lock.
+
+The pack subprocess sends the records it writes, then the storage's
+process sends the records it copies, so the stream arrives over two
+connections, or two openings of a pipe.  Each starts with a 4-byte
+magic number, followed by frames, each with an 8-byte offset, a 4-byte
+length and that many bytes of the file, at that offset.  A frame with
+no data gives the size of the packed file and ends the stream.  If a
+connection ends without one, the pack wasn't used and what was
+received should be discarded.  Nothing is streamed to a named pipe
+that no consumer is reading when the stream starts, and a stream is
+abandoned if its consumer stops reading for `send_timeout` seconds.
+
+``receive`` applies a stream to a file, and ``serve`` listens on a Unix
+socket and receives a stream.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import select
+import socket
+import stat
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+magic = b"ZCPS"
+frame_header = struct.Struct(">QI")
+chunk_size = 1 << 20
+send_timeout = 60.0
+
+
+class NoConsumer(Exception):
+    """No consumer is reading a named pipe
+    """
+
+
+class Stalled(Exception):
+    """A consumer stopped reading
+    """
+
+
+class Connection(object):
+    """A non-blocking connection to a consumer
+
+    Writes wait up to `timeout` seconds for the consumer to read
+    more, and then raise ``Stalled``, so a consumer that stops reading
+    can't hold up a stream, or whoever waits for it, forever.
+    """
+
+    def __init__(self, fd, sock=None, timeout=None):
+        self.fd = fd
+        self.sock = sock  # Keeps the socket open
+        self.timeout = send_timeout if timeout is None else timeout
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            _, writable, _ = select.select([], [self.fd], [], self.timeout)
+            if not writable:
+                raise Stalled("nothing read for %s seconds" % self.timeout)
+            try:
+                n = os.write(self.fd, data)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    continue
+                raise
+            data = data[n:]
+
+    def close(self):
+        if self.sock is None:
+            os.close(self.fd)
+        else:
+            self.sock.close()
+
+
+def connect(path, timeout=None):
+    """Open a stream to the named pipe or Unix socket at `path`
+
+    A ``Connection`` is returned.  ``NoConsumer`` is raised if `path`
+    is a named pipe no one is reading.
+    """
+    if stat.S_ISFIFO(os.stat(path).st_mode):
+        # Opening a pipe to write to it blocks until it has a reader,
+        # so it's opened without blocking, which fails if there's none.
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                raise NoConsumer(path)
+            raise
+        return Connection(fd, timeout=timeout)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except Exception:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return Connection(sock.fileno(), sock, timeout)
+
+
+class Streamer(object):
+    """Stream an output file from `pos` as it's written
+
+    Data are read back from the file, usually from the page cache, by
+    a background thread, up to the position most recently given to
+    ``advance``.
+    """
+
+    def __init__(self, output, path, pos=0):
+        self.output = output
+        self.path = path
+        self.input = open(output.name, "rb")
+        self.pos = self.available = pos
+        self.end = None
+        self.closed = self.aborted = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.run, name="stream %s to %s" % (output.name, path)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def advance(self, pos):
+        """Note that the output is final up to `pos`
+        """
+        if not self.output.closed:
+            self.output.flush()
+        with self.condition:
+            self.available = pos
+            self.condition.notify()
+
+    def written(self, pos):
+        # Advance every so often as transactions are written.
+        if pos - self.available >= chunk_size:
+            self.advance(pos)
+
+    def close(self, pos=None, end=None, abort=False, wait=True):
+        """Stop streaming, when the output up to `pos` has been sent
+
+        If `end` is given, the output is final up to it, and the stream
+        ends with it as the size of the file.  If `abort` is true,
+        streaming stops without sending more.
+        """
+        if end is not None:
+            pos = end
+        if pos is not None:
+            self.advance(pos)
+        with self.condition:
+            self.end = end
+            self.aborted = abort
+            self.closed = True
+            self.condition.notify()
+        if wait:
+            self.thread.join()
+
+    def run(self):
+        try:
+            try:
+                out = connect(self.path)
+            except NoConsumer:
+                logger.warning("no consumer reading %s, not streaming", self.path)
+                return
+            try:
+                out.write(magic)
+                while True:
+                    with self.condition:
+                        while self.pos == self.available and not self.closed:
+                            self.condition.wait()
+                        if self.aborted:
+                            return
+                        available = self.available
+                        closed = self.closed
+                    while self.pos < available:
+                        self.input.seek(self.pos)
+                        data = self.input.read(min(chunk_size, available - self.pos))
+                        if not data:
+                            raise ValueError("output truncated at %s" % self.pos)
+                        out.write(frame_header.pack(self.pos, len(data)))
+                        out.write(data)
+                        self.pos += len(data)
+                    if closed and self.pos >= self.available:
+                        if self.end is not None:
+                            out.write(frame_header.pack(self.end, 0))
+                        return
+            finally:
+                out.close()
+        except Stalled as v:
+            logger.warning("abandoned stream to %s: %s", self.path, v)
+        except Exception:
+            logger.exception("streaming %s to %s", self.output.name, self.path)
+        finally:
+            self.input.close()
+
+
+def receive(f, output):
+    """Apply a stream read from `f` to the file `output`
+
+    The size of the file is returned if the stream ended, or None.
+    """
+    if f.read(len(magic)) != magic:
+        raise ValueError("Not a pack stream")
+    while True:
+        header = f.read(frame_header.size)
+        if len(header) < frame_header.size:
+            return None
+        pos, size = frame_header.unpack(header)
+        if not size:
+            output.truncate(pos)
+            return pos
+        data = f.read(size)
+        if len(data) < size:
+            return None
+        output.seek(pos)
+        output.write(data)
+
+
+def serve(socket_path, path):
+    """Listen on a Unix socket and receive a stream into a file
+
+    Connections are accepted until the stream ends, and the size of the
+    file is returned.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(socket_path)
+        sock.listen(1)
+        with open(path, "w+b") as output:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    f = conn.makefile("rb")
+                    try:
+                        size = receive(f, output)
+                    finally:
+                        f.close()
+                finally:
+                    conn.close()
+                if size is not None:
+                    return size
+    finally:
+        sock.close()
+        os.remove(socket_path)
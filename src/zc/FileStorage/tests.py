@@ -489,7 +489,7 @@ def snapshot_in_time():
     >>> try: zc.FileStorage.snapshotintime.main([])
     ... except SystemExit as v: pass
     ... else: print('oops')
-    Usage: snapshot-in-time [input-path utc-snapshot-time output-path]
+    Usage: snapshot-in-time [options] [input-path utc-snapshot-time output-path]
     <BLANKLINE>
     Make a point-in time snapshot of a file-storage data file containing
     just the current records as of the given time.  The resulting file can
@@ -505,6 +505,24 @@ def snapshot_in_time():
     The UTC time is a string of the form: YYYY-MM-DDTHH:MM:SS.  The time
     conponents are optional.  The time defaults to midnight, UTC.
     <BLANKLINE>
+    Options:
+    <BLANKLINE>
+      -r, --reachable
+          Only include objects reachable from the root object.
+    <BLANKLINE>
+      -o, --oid OID
+          Only include objects reachable from the object with the given
+          oid (an integer, use a 0x prefix for hex).  This option may be
+          given more than once and may be combined with --reachable.
+    <BLANKLINE>
+      -t, --tids
+          Also write a tids file, with the position of each transaction in
+          the snapshot, next to it.  See zc.FileStorage.tids.
+    <BLANKLINE>
+      -f, --frozen-index
+          Also write a sorted oids file, next to the snapshot, so it can be
+          opened immediately with zc.FileStorage.frozen.FrozenFileStorage.
+    <BLANKLINE>
 
     >>> sys.argv[0] = argv0
 
@@ -537,6 +555,1818 @@ def snapshot_in_time():
     """
 
 
+def snapshot_in_time_reachable():
+    r"""Snapshots can be limited to reachable objects
+
+    We'll create a database with some objects that are no longer
+    reachable from the root:
+
+    >>> import datetime, ZODB.FileStorage, ZODB.TimeStamp, transaction
+    >>> conn = ZODB.connection('data.fs')
+    >>> for i in range(4):
+    ...     conn.root()[i] = conn.root().__class__()
+    ...     transaction.commit()
+    >>> conn.root()[0].child = conn.root().__class__()
+    >>> conn.root()[3].child = conn.root().__class__()
+    >>> transaction.commit()
+    >>> del conn.root()[2]
+    >>> del conn.root()[3]
+    >>> transaction.commit()
+    >>> stop = ZODB.TimeStamp.TimeStamp(conn.db().storage.lastTransaction())
+    >>> stop = (datetime.datetime(
+    ...   stop.year(), stop.month(), stop.day(),
+    ...   stop.hour(), stop.minute(), int(stop.second()))
+    ...   + datetime.timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%S')
+    >>> conn.close()
+
+    With the --reachable option, only the root, 2 of its subobjects
+    and a grandchild are copied:
+
+    >>> import zc.FileStorage.snapshotintime
+    >>> zc.FileStorage.snapshotintime.main(
+    ...    ['--reachable', 'data.fs', stop, 'snapshot.fs'])
+    >>> def oids(path):
+    ...     return sorted(ZODB.utils.u64(r.oid)
+    ...                   for t in ZODB.FileStorage.FileIterator(path)
+    ...                   for r in t)
+    >>> oids('snapshot.fs')
+    [0, 1, 2, 5]
+
+    We can also start from specific objects:
+
+    >>> zc.FileStorage.snapshotintime.main(
+    ...    ['-o', '4', '--oid', '0x5', 'data.fs', stop, 'sub.fs'])
+    >>> oids('sub.fs')
+    [4, 5, 6]
+
+    >>> conn = ZODB.connection('snapshot.fs')
+    >>> sorted(conn.root().keys())
+    [0, 1]
+    >>> conn.root()[0].child
+    {}
+    >>> conn.close()
+
+    Each level of the walk is queued as record positions, which are
+    read back in file order.  Past a limit, they're sorted and spilled
+    to a temporary file, and the spilled runs are merged:
+
+    >>> queue = zc.FileStorage.PositionQueue('.', 3)
+    >>> for pos in [50, 10, 70, 30, 20, 60, 40]:
+    ...     queue.append(pos)
+    >>> len(queue), len(queue.runs)
+    (7, 2)
+    >>> list(queue)
+    [10, 20, 30, 40, 50, 60, 70]
+    >>> queue.close()
+    >>> len(queue), list(queue)
+    (0, [])
+
+    Objects referenced many times are queued once, so the snapshot is
+    the same when levels are spilled:
+
+    >>> capacity = zc.FileStorage.PositionQueue.capacity
+    >>> zc.FileStorage.PositionQueue.capacity = 1
+    >>> zc.FileStorage.snapshotintime.main(
+    ...    ['--reachable', 'data.fs', stop, 'spilled.fs'])
+    >>> oids('spilled.fs')
+    [0, 1, 2, 5]
+    >>> zc.FileStorage.PositionQueue.capacity = capacity
+    """
+
+
+def pack_worker():
+    r"""Packs can be done by long-lived worker processes
+
+    >>> import logging, os, sys, transaction, ZODB.FileStorage
+    >>> import zc.FileStorage.worker
+    >>> handler = logging.StreamHandler(sys.stdout)
+    >>> logger = logging.getLogger('zc.FileStorage.worker')
+    >>> logger.addHandler(handler)
+    >>> logger.setLevel(logging.INFO)
+    >>> logger.propagate = False
+
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(worker=True)))
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+
+    Pack log messages are relayed to the parent's log:
+
+    >>> db.pack() # doctest: +ELLIPSIS
+    data.fs: packing to ..., sleep 0
+    data.fs: initial scan 1 objects at 570
+    data.fs: copy to pack time
+    data.fs: copy from pack time
+    data.fs: packscript done
+
+    No script or pack files are left behind:
+
+    >>> sorted(os.listdir('.')) # doctest: +NORMALIZE_WHITESPACE
+    ['data.fs', 'data.fs.index', 'data.fs.lock', 'data.fs.old',
+     'data.fs.packlog', 'data.fs.tmp']
+    >>> conn.root().x
+    2
+
+    The worker is reused for the next pack:
+
+    >>> [worker] = zc.FileStorage.worker._idle
+    >>> conn.root().x = 3
+    >>> transaction.commit()
+    >>> logger.setLevel(logging.WARNING)
+    >>> db.pack()
+    >>> zc.FileStorage.worker._idle == [worker]
+    True
+
+    Errors are raised in the parent:
+
+    >>> db.storage.packer = zc.FileStorage.Packer(
+    ...     worker=True, transform='zc.FileStorage.tests:nosuchthing')
+    >>> conn.root().x = 4
+    >>> transaction.commit()
+    >>> db.pack() # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    NameError: name 'nosuchthing' is not defined
+
+    >>> zc.FileStorage.worker._idle == [worker]
+    True
+
+    Including I/O errors, which aren't mistaken for failures of the
+    worker:
+
+    >>> db.storage.packer = zc.FileStorage.Packer(
+    ...     worker=True, transform='zc.FileStorage.tests:open("nosuchfile")')
+    >>> try:
+    ...     db.pack()
+    ... except EnvironmentError as v:
+    ...     print(v.filename) # doctest: +ELLIPSIS
+    /...data.fs: packing
+    Traceback (most recent call last):
+    ...
+    ...Error: [Errno 2] No such file or directory: 'nosuchfile'
+    nosuchfile
+
+    >>> zc.FileStorage.worker._idle == [worker]
+    True
+
+    Idle workers that died are closed and replaced:
+
+    >>> worker.process.kill()
+    >>> _ = worker.process.wait()
+    >>> db.storage.packer = zc.FileStorage.Packer(worker=True)
+    >>> db.pack()
+    >>> worker.healthy, worker.process.stdout.closed
+    (False, True)
+    >>> [new] = zc.FileStorage.worker._idle
+    >>> new is worker
+    False
+
+    >>> db.close()
+
+    Old blob revisions are removed:
+
+    >>> import ZODB.blob
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'blobs.fs', blob_dir='blobs',
+    ...     packer=zc.FileStorage.Packer(worker=True)))
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root.b = ZODB.blob.Blob(b'blob %d' % i)
+    ...     transaction.commit()
+    >>> db.pack()
+    >>> sorted(f for _, _, files in os.walk('blobs') for f in files
+    ...        if f.endswith('.blob'))
+    ... # doctest: +ELLIPSIS
+    ['0x...blob']
+    >>> db.close()
+
+    >>> zc.FileStorage.worker.shutdown()
+    >>> zc.FileStorage.worker._idle
+    []
+    >>> logger.removeHandler(handler)
+    >>> logger.propagate = True
+    """
+
+
+def background_packs():
+    r"""Packs can be run in the background, paused, resumed and cancelled
+
+    >>> import os, transaction, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.packer))
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+
+    We'll start a pack paused:
+
+    >>> handle = zc.FileStorage.start_pack(db.storage, paused=True)
+    >>> handle.status
+    'paused'
+
+    The pack subprocess pauses between transactions, in this case
+    before the first:
+
+    >>> handle.wait(1)
+    False
+    >>> with open('data.fs.packlog') as f:
+    ...     print(f.read()) # doctest: +ELLIPSIS
+    20... root INFO packing to ..., sleep 0
+    20... root INFO paused at 4
+    <BLANKLINE>
+
+    >>> handle.resume()
+    >>> handle.wait(30)
+    True
+    >>> handle.status, handle.progress[0]
+    ('done', 'copy rest')
+    >>> len(db.storage.undoLog())
+    0
+
+    The handle is passed to the storage's packer for that pack only:
+
+    >>> db.storage.packer is zc.FileStorage.packer
+    True
+
+    Cancelling a pack stops the subprocess and cleans up after it:
+
+    >>> db.storage.packer = zc.FileStorage.Packer(worker=True)
+    >>> for i in range(20):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+    >>> handle = zc.FileStorage.start_pack(db.storage, paused=True)
+    >>> handle.cancel()
+    >>> handle.wait(30)
+    True
+    >>> handle.status
+    'cancelled'
+    >>> sorted(os.listdir('.')) # doctest: +NORMALIZE_WHITESPACE
+    ['data.fs', 'data.fs.index', 'data.fs.lock', 'data.fs.packlog',
+     'data.fs.tmp']
+    >>> len(db.storage.undoLog())
+    20
+
+    Once done, a handle ignores commands:
+
+    >>> handle.resume()
+    >>> handle.status
+    'cancelled'
+
+    >>> db.close()
+    >>> zc.FileStorage.worker.shutdown()
+    """
+
+
+def pack_estimate():
+    r"""We can estimate what a pack will do without packing
+
+    >>> import os, time, transaction, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', blob_dir='blobs', packer=zc.FileStorage.packer))
+    >>> conn = db.open()
+    >>> conn.root.b = ZODB.blob.Blob(b'test')
+    >>> for i in range(20):
+    ...     conn.root().x = i
+    ...     if i % 5 == 0:
+    ...         with conn.root.b.open('w') as f:
+    ...             _ = f.write(b'test %s' % i)
+    ...     transaction.commit()
+    >>> pack_time = time.time()
+    >>> time.sleep(.01)
+    >>> conn.root().x = 'after'
+    >>> transaction.commit()
+
+    >>> import ZODB.TimeStamp
+    >>> stop = ZODB.TimeStamp.TimeStamp(
+    ...     *time.gmtime(pack_time)[:5] + (pack_time % 60,)).raw()
+    >>> packer = zc.FileStorage.PackProcess(
+    ...     'data.fs', stop, os.path.getsize('data.fs'))
+    >>> result = packer.estimate(blobs=True)
+    >>> sorted(os.listdir('.')) # doctest: +NORMALIZE_WHITESPACE
+    ['blobs', 'data.fs', 'data.fs.index', 'data.fs.lock', 'data.fs.tmp']
+    >>> (result['objects'], result['kept_records'], result['dropped_records'],
+    ...  result['blob_revisions_removed'])
+    (2, 2, 23, 3)
+
+    The output-size estimate is exact when every transaction is
+    examined:
+
+    >>> db.pack(pack_time)
+    >>> result['output_size'] == os.path.getsize('data.fs')
+    True
+    >>> result['reclaimed_bytes'] == (
+    ...     result['input_size'] - os.path.getsize('data.fs'))
+    True
+
+    The pack-estimate script prints the results.  It can examine a
+    sample of transactions:
+
+    >>> import zc.FileStorage.estimate
+    >>> for i in range(20):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+    >>> zc.FileStorage.estimate.main(['-s', '.5', 'data.fs'])
+    ... # doctest: +ELLIPSIS
+    pack time:              ...
+    input size:             ...
+    output size:            ...
+    reclaimed bytes:        ...
+    objects:                2
+    kept records:           ...
+    kept bytes:             ...
+    dropped records:        ...
+    dropped bytes:          ...
+    blob revisions removed: 0
+    sample:                 0.5
+    estimated seconds:      ...
+
+    >>> import sys
+    >>> stderr, sys.stderr = sys.stderr, sys.stdout
+    >>> try: zc.FileStorage.estimate.main(['-s', '2', 'data.fs'])
+    ... except SystemExit: pass
+    ... else: print('oops')
+    ... # doctest: +ELLIPSIS
+    Usage: ... [options] input-path [utc-pack-time]
+    ...
+    >>> sys.stderr = stderr
+
+    >>> db.close()
+    """
+
+
+def pack_report():
+    r"""Packs can report where garbage comes from
+
+    >>> import os, time, transaction, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', blob_dir='blobs',
+    ...     packer=zc.FileStorage.Packer(report=2)))
+    >>> conn = db.open()
+    >>> conn.root.b = ZODB.blob.Blob(b'test')
+    >>> transaction.commit()
+    >>> for i in range(20):
+    ...     conn.root().x = i
+    ...     if i % 5 == 0:
+    ...         with conn.root.b.open('w') as f:
+    ...             _ = f.write(b'test %s' % i)
+    ...     transaction.commit()
+    >>> db.pack()
+
+    The report is written next to the storage:
+
+    >>> with open('data.fs.packreport') as f:
+    ...     print(f.read()) # doctest: +NORMALIZE_WHITESPACE
+    class                                  kept   kept bytes   dropped  dropped bytes
+    persistent.mapping.PersistentMapping      1          142        21           2936
+    ZODB.blob.Blob                            1           63         4            252
+    <BLANKLINE>
+    oid                   revisions
+    0x0                          22
+    0x1                           5
+    <BLANKLINE>
+    transaction size <=       count
+    256                          22
+    <BLANKLINE>
+
+    >>> db.close()
+    """
+
+
+def pack_garbage():
+    r"""Packs can drop garbage found by an external garbage collector
+
+    >>> import os, transaction, ZODB.FileStorage, ZODB.POSException
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', blob_dir='blobs', packer=zc.FileStorage.packer))
+    >>> conn = db.open()
+    >>> for i in range(4):
+    ...     conn.root()[i] = ZODB.blob.Blob(b'blob %s' % i)
+    ...     transaction.commit()
+    >>> oids = [conn.root()[i]._p_oid for i in range(4)]
+    >>> for i in range(4):
+    ...     del conn.root()[i]
+    >>> transaction.commit()
+    >>> conn.cacheMinimize()
+
+    Objects 1 and 2 are no longer referenced.  A garbage collector,
+    like zc.zodbdgc, can list their oids in a file, one per line,
+    in decimal or in hex:
+
+    >>> with open('garbage', 'w') as f:
+    ...     _ = f.write('# garbage\n%s\n0x%x\n' % (
+    ...         ZODB.utils.u64(oids[0]), ZODB.utils.u64(oids[1])))
+    >>> list(zc.FileStorage.load_garbage('garbage')) == oids[:2]
+    True
+
+    Or save them as a bitmap:
+
+    >>> bitmap = zc.FileStorage.GarbageBitmap.fromOids(oids[2:3])
+    >>> bitmap.save('garbage.bitmap')
+    >>> bitmap = zc.FileStorage.load_garbage('garbage.bitmap')
+    >>> list(bitmap) == oids[2:3], len(bitmap), oids[2] in bitmap
+    (True, 1, True)
+
+    Packing with a garbage file drops the garbage and removes its
+    blobs in the same pass:
+
+    >>> def blobs():
+    ...     return sum(f.endswith('.blob')
+    ...                for _, _, files in os.walk('blobs') for f in files)
+    >>> blobs()
+    4
+    >>> db.storage.packer = zc.FileStorage.Packer(garbage='garbage')
+    >>> db.pack()
+    >>> for oid in oids:
+    ...     try:
+    ...         _ = db.storage.load(oid)
+    ...     except ZODB.POSException.POSKeyError:
+    ...         print('gone')
+    ...     else:
+    ...         print('kept')
+    gone
+    gone
+    kept
+    kept
+    >>> blobs()
+    2
+
+    >>> db.storage.packer = zc.FileStorage.Packer(garbage='garbage.bitmap')
+    >>> db.pack()
+    >>> blobs()
+    1
+
+    >>> db.close()
+    """
+
+
+def pack_dedup():
+    r"""Packs can replace records identical to earlier revisions with
+    backpointers
+
+    >>> import os, time, transaction, ZODB.FileStorage
+    >>> def make(name, packer):
+    ...     db = ZODB.DB(ZODB.FileStorage.FileStorage(name, packer=packer))
+    ...     conn = db.open()
+    ...     conn.root().x = 'x' * 1000
+    ...     transaction.commit()
+    ...     conn.root().y = 1
+    ...     transaction.commit()
+    ...     pack_time = time.time()
+    ...     time.sleep(.01)
+    ...     for i in range(10):
+    ...         conn.root().x = conn.root().x
+    ...         conn.root()._p_changed = True
+    ...         transaction.commit()
+    ...     return db, pack_time
+
+    >>> db, pack_time = make('plain.fs', zc.FileStorage.packer)
+    >>> db.pack(pack_time)
+    >>> db.close()
+
+    All of the revisions after the pack time repeat the current record
+    at the pack time, so they're all replaced:
+
+    >>> db, pack_time = make(
+    ...     'data.fs', zc.FileStorage.Packer(dedup=True))
+    >>> db.pack(pack_time)
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'duplicate' in l])
+    ... # doctest: +ELLIPSIS
+    ['10 duplicate records (...) replaced by backpointers\n']
+
+    >>> os.path.getsize('data.fs') < os.path.getsize('plain.fs') - 10000
+    True
+    >>> db.storage.load(ZODB.utils.z64)[0] == (
+    ...     ZODB.FileStorage.FileStorage('plain.fs', read_only=True)
+    ...     .load(ZODB.utils.z64)[0])
+    True
+    >>> conn = db.open()
+    >>> len(conn.root().x), conn.root().y
+    (1000, 1)
+    >>> db.close()
+
+    The same records are replaced when copying to the pack time in
+    parallel:
+
+    >>> db, pack_time = make(
+    ...     'parallel.fs', zc.FileStorage.Packer(dedup=True, copy_processes=2))
+    >>> db.pack(pack_time)
+    >>> os.path.getsize('parallel.fs') == os.path.getsize('data.fs')
+    True
+    >>> db.close()
+
+    >>> finder = zc.FileStorage.DuplicateFinder(2)
+    >>> finder.find(b'1', b'data')[0], finder.found
+    (0, 0)
+    >>> finder.remember(b'1', finder.find(b'1', b'data')[1], 42)
+    >>> finder.find(b'1', b'data')[0], finder.found, finder.found_bytes
+    (42, 1, 4)
+    >>> finder.find(b'1', b'other')[0]
+    0
+    >>> for oid in b'2', b'3':
+    ...     finder.remember(oid, finder.find(oid, b'data')[1], 0)
+    >>> sorted(finder.records)
+    ['2', '3']
+    """
+
+
+def pack_keeps_backpointers():
+    r"""Backpointers after the pack time are kept if the records they
+    point to are kept
+
+    >>> import time, transaction, ZODB.FileStorage
+    >>> import ZODB.scripts.fstest
+    >>> from persistent.mapping import PersistentMapping
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.packer))
+    >>> conn = db.open()
+    >>> a = conn.root().a = PersistentMapping(x='a' * 1000)
+    >>> b = conn.root().b = PersistentMapping(x='b' * 1000)
+    >>> transaction.commit()
+    >>> b['x'] = 'b2'
+    >>> transaction.commit()
+    >>> pack_time = time.time()
+    >>> time.sleep(.01)
+
+    We change `a` and undo the change, which writes a backpointer to
+    the record current at the pack time.  Undoing the change to `b`
+    writes a backpointer to a record the pack drops:
+
+    >>> a['x'] = 'a2'
+    >>> transaction.commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+    >>> db.undo(db.undoLog(2, 3)[0]['id'])
+    >>> transaction.commit()
+    >>> conn.cacheMinimize()
+    >>> a['x'] == 'a' * 1000, b['x'] == 'b' * 1000
+    (True, True)
+
+    >>> db.pack(pack_time)
+    >>> ZODB.scripts.fstest.check('data.fs')
+
+    The records for `a` and `b` at the pack time are followed by the
+    change to `a` and the two undos.  Only the undo of the change to
+    `a` has a backpointer:
+
+    >>> for t in db.storage.iterator():
+    ...     for r in t:
+    ...         if r.oid in (a._p_oid, b._p_oid):
+    ...             print('%s %s' % (r.oid == a._p_oid and 'a' or 'b',
+    ...                              r.data_txn is not None))
+    a False
+    b False
+    a False
+    a True
+    b False
+
+    >>> conn.cacheMinimize()
+    >>> a['x'] == 'a' * 1000, b['x'] == 'b' * 1000
+    (True, True)
+    >>> db.close()
+    """
+
+
+def pack_compress():
+    r"""Packs can compress records
+
+    >>> import transaction, ZODB.FileStorage
+    >>> import zc.FileStorage.compression
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(compress=6)))
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root().x = 'x' * 1000
+    ...     conn.root().i = i
+    ...     transaction.commit()
+    >>> db.pack()
+    >>> db.close()
+
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'compressed' in l])
+    ... # doctest: +ELLIPSIS
+    ['zlib compressed 1 of 1 records, 10... to ... bytes (...%), ... CPU seconds\n']
+
+    Records are compressed as by zc.zlibstorage:
+
+    >>> storage = ZODB.FileStorage.FileStorage('data.fs', read_only=True)
+    >>> data = storage.load(ZODB.utils.z64)[0]
+    >>> data[:2] == b'.z', len(data) < 100
+    (True, True)
+    >>> data = zc.FileStorage.compression.decompress(data)
+    >>> pickle.loads(data).__name__
+    'PersistentMapping'
+    >>> storage.close()
+
+    Records that are already compressed or don't get smaller are left
+    alone:
+
+    >>> compressor = zc.FileStorage.compression.Compressor()
+    >>> compressed = compressor.compress(b'y' * 100)
+    >>> compressed[:2] == b'.z'
+    True
+    >>> compressor.compress(compressed) == compressed
+    True
+    >>> compressor.compress(b'xy') == b'xy'
+    True
+    >>> zc.FileStorage.compression.decompress(compressed) == b'y' * 100
+    True
+    >>> print(compressor.stats()) # doctest: +ELLIPSIS
+    zlib compressed 1 of 3 records, 1... to ... bytes (...%), ... CPU seconds
+    """
+
+
+def pack_checksums():
+    r"""Packs can write record checksums, which can be used to scrub storages
+
+    >>> import os, threading, transaction, ZODB.FileStorage
+    >>> import zc.FileStorage.checksums
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(checksums=True)))
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root()[i] = i
+    ...     transaction.commit()
+
+    Records committed while the pack is running are covered too:
+
+    >>> commit_lock_acquire = db.storage._commit_lock_acquire
+    >>> def _commit_lock_acquire():
+    ...     if (threading.current_thread().name == 'packer'
+    ...         and db.storage._commit_lock_acquire is not commit_lock_acquire):
+    ...         db.storage._commit_lock_acquire = commit_lock_acquire
+    ...         conn2 = db.open()
+    ...         conn2.root()['during'] = 1
+    ...         transaction.commit()
+    ...         conn2.close()
+    ...     commit_lock_acquire()
+    >>> db.storage._commit_lock_acquire = _commit_lock_acquire
+    >>> thread = threading.Thread(target=db.pack, name='packer')
+    >>> thread.start()
+    >>> thread.join()
+    >>> conn.sync()
+    >>> conn.root()['during']
+    1
+
+    >>> sorted(f for f in os.listdir('.') if 'checksums' in f)
+    ['data.fs.checksums']
+    >>> zc.FileStorage.checksums.entries('data.fs.checksums')
+    2
+    >>> zc.FileStorage.checksums.scrub('data.fs', processes=2)
+    ([], 2)
+
+    Checksums are moved into place just before the packed file
+    replaces the storage's file.  If that fails, they don't match the
+    storage's file, and aren't used:
+
+    >>> conn.root()['x'] = 1
+    >>> transaction.commit()
+    >>> rename = os.rename
+    >>> def failing_rename(src, dst):
+    ...     if dst.endswith('.old'):
+    ...         raise OSError('rename failed')
+    ...     rename(src, dst)
+    >>> os.rename = failing_rename
+    >>> db.pack()
+    Traceback (most recent call last):
+    ...
+    OSError: rename failed
+    >>> os.rename = rename
+    >>> sorted(f for f in os.listdir('.') if 'checksums' in f)
+    ['data.fs.checksums']
+    >>> zc.FileStorage.checksums.matches('data.fs', 'data.fs.checksums')
+    False
+    >>> zc.FileStorage.checksums.scrub('data.fs', processes=1)
+    Traceback (most recent call last):
+    ...
+    ValueError: data.fs.checksums doesn't match data.fs
+
+    >>> db.pack()
+    >>> sorted(f for f in os.listdir('.') if 'checksums' in f)
+    ['data.fs.checksums']
+    >>> zc.FileStorage.checksums.scrub('data.fs', processes=1)
+    ([], 1)
+
+    The scrubber finds corrupted records:
+
+    >>> with open('data.fs.checksums', 'rb') as f:
+    ...     _ = f.read(zc.FileStorage.checksums.header_size)
+    ...     pos, _ = zc.FileStorage.checksums.entry.unpack(f.read(12))
+    >>> db.close()
+    >>> with open('data.fs', 'r+b') as f:
+    ...     f.seek(pos + 50)
+    ...     _ = f.write(b'!')
+    >>> zc.FileStorage.checksums.scrub('data.fs') == ([(pos, 'checksum mismatch')], 1)
+    True
+
+    >>> import sys
+    >>> sys.argv[0] = 'scrub-checksums'
+    >>> zc.FileStorage.checksums.main(['-p1', 'data.fs']) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    SystemExit: 1
+
+    Packing without checksums removes checksums that no longer match:
+
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage('other.fs'))
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root()[i] = i
+    ...     transaction.commit()
+    >>> db.storage.packer = zc.FileStorage.Packer(checksums=True)
+    >>> db.pack()
+    >>> os.path.exists('other.fs.checksums')
+    True
+    >>> conn.root()[0] = 4
+    >>> transaction.commit()
+    >>> db.storage.packer = zc.FileStorage.packer
+    >>> db.pack()
+    >>> os.path.exists('other.fs.checksums')
+    False
+    >>> db.close()
+    """
+
+
+def pack_verify():
+    r"""Packed files can be verified before they're used
+
+    >>> import shutil, transaction, ZODB.FileStorage
+    >>> import zc.FileStorage.verify
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(verify=2)))
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i % 5] = i
+    ...     transaction.commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'verified' in l])
+    ... # doctest: +ELLIPSIS
+    ['verified 1 transactions, 1 records in ... seconds\n']
+
+    Records copied after the pack subprocess finishes are verified in
+    the storage's process with `verify_tail`, which only checks the
+    index for the objects it sees.  Both can be used directly:
+
+    >>> for i in range(20):
+    ...     conn.root()[i % 5] = i
+    ...     transaction.commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+    >>> index = db.storage._index
+    >>> pos = db.storage._pos
+    >>> db.close()
+
+    >>> zc.FileStorage.verify.verify('data.fs', index, processes=2)
+    >>> zc.FileStorage.verify.verify_tail('data.fs', index, 4, pos)
+    (22, 22)
+
+    Problems are reported as errors:
+
+    >>> shutil.copy('data.fs', 'bad.fs')
+    >>> with open('bad.fs', 'r+b') as f:
+    ...     f.seek(pos - 1)
+    ...     _ = f.write(b'\xff')
+    >>> zc.FileStorage.verify.verify('bad.fs', index, processes=2)
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    CorruptedError: bad.fs:...:redundant transaction length does not match ...
+
+    Backpointers must point to earlier records:
+
+    >>> record = [r for t in ZODB.FileStorage.FileIterator('data.fs') for r in t][-1]
+    >>> shutil.copy('data.fs', 'bad.fs')
+    >>> with open('bad.fs', 'r+b') as f:
+    ...     _ = f.seek(record.pos + 42)
+    ...     _ = f.write(ZODB.utils.p64(record.pos))
+    >>> zc.FileStorage.verify.verify('bad.fs', index, processes=1)
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    CorruptedError: bad.fs:...:back pointer to a later record: ...
+
+    >>> index[ZODB.utils.p64(1)] = 4
+    >>> zc.FileStorage.verify.verify('data.fs', index, processes=1)
+    Traceback (most recent call last):
+    ...
+    CorruptedError: data.fs:4:1 of 2 index positions are wrong
+
+    Files that fail verification are removed, with their sidecars:
+
+    >>> import os
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(verify=2, checksums=True)))
+    >>> conn = db.open()
+    >>> conn.root()[0] = 'x'
+    >>> transaction.commit()
+    >>> verify_tail = zc.FileStorage.verify.verify_tail
+    >>> def bad_verify_tail(*args):
+    ...     raise ValueError('bad')
+    >>> zc.FileStorage.verify.verify_tail = bad_verify_tail
+    >>> db.pack()
+    Traceback (most recent call last):
+    ...
+    ValueError: bad
+    >>> zc.FileStorage.verify.verify_tail = verify_tail
+    >>> sorted(f for f in os.listdir('.') if f.startswith('data.fs.pack'))
+    ['data.fs.packlog']
+    >>> conn.root()[0] = 'y'
+    >>> transaction.commit()
+    >>> stop = db.storage.lastTransaction()
+    >>> db.close()
+
+    The same goes for files verified by the pack subprocess:
+
+    >>> verify = zc.FileStorage.verify.verify
+    >>> def bad_verify(*args):
+    ...     raise ValueError('bad')
+    >>> zc.FileStorage.verify.verify = bad_verify
+    >>> zc.FileStorage.PackProcess(
+    ...     'data.fs', stop, os.path.getsize('data.fs'), verify=1,
+    ...     checksums=True).pack()
+    Traceback (most recent call last):
+    ...
+    ValueError: bad
+    >>> zc.FileStorage.verify.verify = verify
+    >>> sorted(f for f in os.listdir('.') if f.startswith('data.fs.pack'))
+    ['data.fs.packlog']
+    """
+
+
+def pack_checks():
+    r"""The checks made while building the pack index can be reduced
+
+    >>> import logging, os, sys, transaction, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(checks=3)))
+    >>> conn = db.open()
+    >>> for i in range(9):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print(''.join(l.split(' INFO ')[1] for l in f if 'check' in l))
+    checking every 3 transactions
+    skipped checks of 6 of 10 transactions
+    <BLANKLINE>
+
+    We'll add a couple of transactions after the pack and break the
+    redundant length of the last one.  Full checks catch it.  Checking
+    headers only, or the first of every 3 transactions, doesn't:
+
+    >>> for i in range(2):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+    >>> db.close()
+    >>> size = os.path.getsize('data.fs')
+    >>> with open('data.fs', 'r+b') as f:
+    ...     f.seek(size - 1)
+    ...     _ = f.write(b'\xff')
+    >>> handler = logging.StreamHandler(sys.stdout)
+    >>> logging.getLogger().addHandler(handler)
+    >>> old_level = logging.getLogger().level
+    >>> logging.getLogger().setLevel(logging.INFO)
+    >>> for checks in 'full', 'headers', 3:
+    ...     packer = zc.FileStorage.PackProcess(
+    ...         'data.fs', b'\xff' * 8, size, checks=checks)
+    ...     try:
+    ...         packed, index, pos = packer.buildPackIndex(b'\xff' * 8, size)
+    ...     except ZODB.FileStorage.format.CorruptedError:
+    ...         print('corrupted')
+    ...     packer._file.close()
+    ... # doctest: +ELLIPSIS
+    packing to ...
+    data.fs:...:redundant transaction length does not match initial ...
+    corrupted
+    packing to ...
+    checking transaction headers only, not data records or redundant transaction lengths
+    packing to ...
+    checking every 3 transactions
+    skipped checks of 2 of 3 transactions
+    >>> logging.getLogger().setLevel(old_level)
+    >>> logging.getLogger().removeHandler(handler)
+
+    >>> zc.FileStorage.PackProcess('data.fs', b'\xff' * 8, size, checks=0)
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Invalid checks', 0)
+    """
+
+
+def pack_dir():
+    r"""Pack output can be written to another directory
+
+    This lets the output be written to a different device than the one
+    being read.  The output is moved next to the storage before records
+    written during the pack are copied:
+
+    >>> import os, transaction, ZODB.FileStorage
+    >>> os.mkdir('scratch')
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(
+    ...         pack_dir='scratch', checksums=True, verify=1)))
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print(''.join(l.split(' INFO ')[1] for l in f
+    ...                   if 'scratch' in l or 'verified' in l))
+    ... # doctest: +ELLIPSIS
+    writing pack output to scratch/data.fs.pack
+    moved scratch/data.fs.pack to data.fs.pack in ... seconds
+    verified 1 transactions, 1 records in ... seconds
+    <BLANKLINE>
+    >>> os.listdir('scratch')
+    []
+    >>> sorted(f for f in os.listdir('.') if f.startswith('data.fs.pack'))
+    ['data.fs.packlog']
+    >>> os.path.exists('data.fs.checksums')
+    True
+    >>> conn.root().x
+    9
+    >>> db.close()
+
+    Before anything is written, we make sure there's room for the
+    output.  That's usually no bigger than the storage, but can be, if
+    backpointers to records before the pack time are replaced by data,
+    so we allow some headroom:
+
+    >>> zc.FileStorage.pack_space_needed(1000)
+    1250
+
+    >>> zc.FileStorage.check_free_space('scratch', 1 << 70)
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    FileStorageQuotaError: ... bytes are needed in scratch, but only ... are available
+
+    When the output is on another file system, it's copied, using
+    ``os.copy_file_range`` where available:
+
+    >>> with open('data.fs', 'rb') as input:
+    ...     with open('copy.fs', 'wb') as output:
+    ...         zc.FileStorage.copy_file(input, output)
+    >>> with open('data.fs', 'rb') as f1:
+    ...     with open('copy.fs', 'rb') as f2:
+    ...         f1.read() == f2.read()
+    True
+    """
+
+
+def pack_preallocate():
+    r"""Space for pack output can be reserved before it's written
+
+    >>> import os, transaction, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(preallocate=True, verify=1)))
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+    >>> size = os.path.getsize('data.fs')
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print(''.join(l.split(' INFO ')[1] for l in f
+    ...                   if 'preallocate' in l or 'verified' in l))
+    ... # doctest: +ELLIPSIS
+    preallocated ... bytes
+    verified 1 transactions, 1 records in ... seconds
+    <BLANKLINE>
+
+    The unused space is given back:
+
+    >>> os.path.getsize('data.fs') < size
+    True
+    >>> conn.root().x
+    9
+    >>> db.close()
+    """
+
+
+def pack_large_transactions():
+    r"""Index updates for large transactions are spilled to disk
+
+    While a transaction is copied, the positions of its records are
+    collected in a TransactionIndex, which keeps 16 bytes per record
+    in memory, up to a limit, and then spills them to a temporary
+    file:
+
+    >>> from ZODB.utils import p64
+    >>> tindex = zc.FileStorage.TransactionIndex('.', 2)
+    >>> for i in range(5):
+    ...     tindex[p64(i)] = i * 100
+    >>> len(tindex), tindex.spilled
+    (5, 4)
+    >>> [(zc.FileStorage.u64(oid), pos) for oid, pos in tindex.items()]
+    [(0, 0), (1, 100), (2, 200), (3, 300), (4, 400)]
+    >>> tindex.clear()
+    >>> len(tindex), list(tindex.items())
+    (0, [])
+
+    When transaction indexes are spilled, the largest transaction
+    copied and peak memory use are logged, by the pack subprocess and
+    by the storage's process, which copies transactions committed
+    during the pack.  Otherwise, they're logged at DEBUG level:
+
+    >>> import logging, sys, threading, transaction, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.packer))
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root()[i] = i
+    ...     transaction.commit()
+
+    >>> capacity = zc.FileStorage.TransactionIndex.capacity
+    >>> zc.FileStorage.TransactionIndex.capacity = 10
+    >>> commit_lock_acquire = db.storage._commit_lock_acquire
+    >>> def _commit_lock_acquire():
+    ...     if (threading.current_thread().name == 'packer'
+    ...         and db.storage._commit_lock_acquire is not commit_lock_acquire):
+    ...         db.storage._commit_lock_acquire = commit_lock_acquire
+    ...         conn2 = db.open()
+    ...         for i in range(25):
+    ...             conn2.root()[i] = conn2.root().__class__()
+    ...         transaction.commit()
+    ...         conn2.close()
+    ...     commit_lock_acquire()
+    >>> db.storage._commit_lock_acquire = _commit_lock_acquire
+    >>> handler = logging.StreamHandler(sys.stdout)
+    >>> logger = logging.getLogger('zc.FileStorage')
+    >>> logger.addHandler(handler)
+    >>> logger.setLevel(logging.INFO)
+    >>> thread = threading.Thread(target=db.pack, name='packer')
+    >>> thread.start()
+    >>> thread.join() # doctest: +ELLIPSIS
+    largest transaction copied: 26 records, ... bytes
+    1 transaction indexes spilled to disk
+    peak memory use: ... KB
+    >>> logger.removeHandler(handler)
+    >>> logger.setLevel(logging.NOTSET)
+    >>> zc.FileStorage.TransactionIndex.capacity = capacity
+
+    >>> conn.sync()
+    >>> len(conn.root())
+    25
+    >>> db.close()
+    """
+
+
+def pack_map_input():
+    r"""The file being packed can be memory mapped
+
+    >>> import os, transaction, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(map_input=True, verify=1)))
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root()[i % 3] = i
+    ...     transaction.commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'verified' in l])
+    ... # doctest: +ELLIPSIS
+    ['verified 1 transactions, 1 records in ... seconds\n']
+    >>> sorted(conn.root().items())
+    [(0, 6), (1, 7), (2, 8)]
+    >>> db.close()
+
+    Reads are served from the mapping, up to the size given:
+
+    >>> size = os.path.getsize('data.fs')
+    >>> f = zc.FileStorage.MappedFile('data.fs', size - 8)
+    >>> with open('data.fs', 'rb') as g:
+    ...     data = g.read()
+    >>> f.read(4) == data[:4]
+    True
+    >>> f.seek(100)
+    >>> f.read(10) == data[100:110], f.tell()
+    (True, 110)
+    >>> f.seek(-4, 2)
+    >>> f.read(100) == data[-12:-8], f.tell() == size - 8
+    (True, True)
+    >>> f.read() == b''
+    True
+    >>> f.dontneed(size)
+    >>> f.close()
+    """
+
+
+def pack_copy_processes():
+    r"""Copying to the pack time can be done by several processes
+
+    >>> import os, shutil, transaction, ZODB.FileStorage
+    >>> from persistent.mapping import PersistentMapping
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage('data.fs'))
+    >>> conn = db.open()
+    >>> for i in range(7):
+    ...     conn.root()[i] = PersistentMapping()
+    >>> transaction.commit()
+    >>> for i in range(50):
+    ...     conn.root()[i % 7]['x'] = i
+    ...     transaction.commit()
+    >>> stop = db.storage.lastTransaction()
+
+    Undoing a change made after the pack time writes a backpointer to a
+    record that's copied:
+
+    >>> conn.root()[3]['x'] = 'changed'
+    >>> transaction.commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+    >>> db.close()
+
+    The output is the same as when copying serially:
+
+    >>> shutil.copyfile('data.fs', 'serial.fs')
+    >>> size = os.path.getsize('data.fs')
+    >>> serial_index, serial_pos = zc.FileStorage.PackProcess(
+    ...     'serial.fs', stop, size).pack()
+    >>> index, pos = zc.FileStorage.PackProcess(
+    ...     'data.fs', stop, size, copy_processes=3).pack()
+    >>> pos == serial_pos, dict(index.items()) == dict(serial_index.items())
+    (True, True)
+    >>> with open('data.fs.pack', 'rb') as f:
+    ...     with open('serial.fs.pack', 'rb') as g:
+    ...         f.read() == g.read()
+    True
+    >>> [f for f in os.listdir('.') if 'segment' in f]
+    []
+
+    Record checksums and transaction positions are the same too:
+
+    >>> _ = zc.FileStorage.PackProcess(
+    ...     'serial.fs', stop, size, checksums=True, tids=True).pack()
+    >>> _ = zc.FileStorage.PackProcess(
+    ...     'data.fs', stop, size, checksums=True, tids=True,
+    ...     copy_processes=2).pack()
+    >>> import zc.FileStorage.checksums
+    >>> zc.FileStorage.checksums.scrub('data.fs.pack', processes=1)[0]
+    []
+    >>> for suffix in '.checksums', '.tids':
+    ...     with open('data.fs.pack' + suffix, 'rb') as f:
+    ...         with open('serial.fs.pack' + suffix, 'rb') as g:
+    ...             print(f.read() == g.read())
+    True
+    True
+
+    Reports can't be written when copying in parallel:
+
+    >>> zc.FileStorage.PackProcess(
+    ...     'data.fs', stop, size, report=True, copy_processes=3)
+    Traceback (most recent call last):
+    ...
+    ValueError: copy_processes and report can't be used together
+    """
+
+
+def pack_archive():
+    r"""History can be archived rather than discarded
+
+    >>> import os, transaction, ZODB.blob, ZODB.FileStorage
+    >>> from ZODB.utils import z64
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', blob_dir='blobs',
+    ...     packer=zc.FileStorage.Packer(archive='archive.fs')))
+    >>> conn = db.open()
+    >>> conn.root().blob = ZODB.blob.Blob(b'blob 0')
+    >>> transaction.commit()
+    >>> tids = []
+    >>> for i in range(5):
+    ...     conn.root().x = i
+    ...     transaction.get().note(u'set x to %s' % i)
+    ...     transaction.commit()
+    ...     tids.append(conn.root()._p_serial)
+    >>> with conn.root().blob.open('w') as f:
+    ...     _ = f.write(b'blob 1')
+    >>> transaction.commit()
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'archived' in l])
+    ['archived 8 transactions, 9 records\n']
+
+    The packed file only has current records, but the archive has all
+    of them, along with the transaction metadata, and the blobs:
+
+    >>> db.storage.loadSerial(z64, tids[0])
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    POSKeyError: 0x00
+
+    >>> archive = ZODB.FileStorage.FileStorage(
+    ...     'archive.fs', blob_dir='archive.fs.blobs', read_only=True)
+    >>> archive.lastTransaction() == db.storage.lastTransaction()
+    True
+    >>> [t.description for t in archive.iterator()][2:4]
+    ['set x to 0', 'set x to 1']
+    >>> archive_db = ZODB.DB(archive)
+    >>> archive_conn = archive_db.open(at=tids[2])
+    >>> archive_conn.root().x
+    2
+    >>> with archive_conn.root().blob.open() as f:
+    ...     f.read() == b'blob 0'
+    True
+    >>> archive_db.close()
+
+    Later packs only archive transactions committed since:
+
+    >>> for i in range(3):
+    ...     conn.root().x = i
+    ...     transaction.commit()
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'archived' in l])
+    ['archived 3 transactions, 3 records\n']
+    >>> archive = ZODB.FileStorage.FileStorage('archive.fs', read_only=True)
+    >>> len(list(archive.iterator()))
+    11
+    >>> archive.close()
+    >>> db.close()
+    """
+
+
+def pack_tids():
+    r"""Packing can save transaction positions for fast lookup by time
+
+    >>> import os, transaction, zc.FileStorage.tids
+    >>> from persistent.mapping import PersistentMapping
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(tids=True)))
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root()[i] = PersistentMapping()
+    ...     transaction.commit()
+    >>> db.pack()
+    >>> for i in range(3):
+    ...     conn.root()[0][i] = i
+    ...     transaction.commit()
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'positions' in l])
+    ['10 transaction positions written\n']
+
+    The tids file covers transactions copied by the pack subprocess,
+    and transactions committed during the pack:
+
+    >>> tids = [t.tid for t in db.storage.iterator()]
+    >>> index = zc.FileStorage.tids.TidIndex('data.fs.tids')
+    >>> [tid for tid, pos in (index[i] for i in range(len(index)))] == tids
+    True
+    >>> with open('data.fs', 'rb') as f:
+    ...     for tid, pos in (index[i] for i in range(len(index))):
+    ...         _ = f.seek(pos)
+    ...         if f.read(8) != tid:
+    ...             print('bad position', pos)
+
+    Transactions are found by binary search:
+
+    >>> index.find(tids[3]) == index[3]
+    True
+    >>> index.before(tids[3]) == index[2]
+    True
+    >>> index.find(b'\xff' * 8), index.before(b'\0' * 8)
+    (None, None)
+    >>> index.close()
+
+    and iterated from there:
+
+    >>> [t.tid for t in zc.FileStorage.tids.iterator(
+    ...     'data.fs', tids[3], tids[5])] == tids[3:6]
+    True
+    >>> [t.tid for t in zc.FileStorage.tids.iterator(
+    ...     'data.fs', b'\xff' * 8)]
+    []
+
+    Copying in parallel gives the same positions:
+
+    >>> db.close()
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(
+    ...         tids=True, copy_processes=2)))
+    >>> for i in range(3):
+    ...     with db.transaction() as conn:
+    ...         conn.root()[1][i] = i
+    >>> db.pack()
+    >>> tids = [t.tid for t in db.storage.iterator()]
+    >>> index = zc.FileStorage.tids.TidIndex('data.fs.tids')
+    >>> [index[i][0] for i in range(len(index))] == tids
+    True
+    >>> index.matches('data.fs')
+    True
+    >>> index.close()
+
+    Tids files that don't match the file, such as those of a packed
+    file that didn't replace the storage's, are ignored:
+
+    >>> writer = zc.FileStorage.tids.TidWriter('other.tids')
+    >>> writer.add(b'\0' * 7 + b'\1', 4)
+    >>> writer.close()
+    >>> index = zc.FileStorage.tids.TidIndex('other.tids')
+    >>> index.matches('data.fs')
+    False
+    >>> index.close()
+    >>> [t.tid for t in zc.FileStorage.tids.iterator(
+    ...     'data.fs', tids[3], tids[5], 'other.tids')] == tids[3:6]
+    True
+
+    Packing without tids removes the positions, which no longer match:
+
+    >>> db.storage.packer = zc.FileStorage.packer
+    >>> with db.transaction() as conn:
+    ...     conn.root()[1][0] = 'x'
+    >>> db.pack()
+    >>> os.path.exists('data.fs.tids')
+    False
+    >>> db.close()
+    """
+
+
+def snapshot_frozen_index():
+    r"""Snapshots can have frozen indexes, for quick opening
+
+    >>> import os, transaction, zc.FileStorage.frozen
+    >>> import zc.FileStorage.snapshotintime
+    >>> from ZODB.utils import p64, z64
+    >>> from persistent.mapping import PersistentMapping
+    >>> conn = ZODB.connection('data.fs')
+    >>> for i in range(20):
+    ...     conn.root()[i] = PersistentMapping(x=i)
+    ...     transaction.commit()
+    >>> conn.db().close()
+    >>> zc.FileStorage.snapshotintime.main(
+    ...    ['--frozen-index', 'data.fs', '2030-01-01', 'snapshot.fs'])
+    >>> sorted(f for f in os.listdir('.') if f.startswith('snapshot'))
+    ['snapshot.fs', 'snapshot.fs.index', 'snapshot.fs.oids']
+
+    The frozen storage searches the oids file rather than loading an
+    index:
+
+    >>> storage = zc.FileStorage.frozen.FrozenFileStorage('snapshot.fs')
+    >>> storage._index # doctest: +ELLIPSIS
+    <zc.FileStorage.frozen.FrozenIndex object at ...>
+    >>> len(storage)
+    21
+    >>> db = ZODB.DB(storage)
+    >>> conn = db.open()
+    >>> [conn.root()[i]['x'] for i in range(20)] == list(range(20))
+    True
+    >>> storage.load(p64(42)) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    POSKeyError: 0x2a
+
+    It's read only, and can be used as the base of a demo storage:
+
+    >>> storage.isReadOnly()
+    True
+    >>> db.close()
+    >>> import ZODB.DemoStorage
+    >>> db = ZODB.DB(ZODB.DemoStorage.DemoStorage(
+    ...     base=zc.FileStorage.frozen.FrozenFileStorage('snapshot.fs')))
+    >>> with db.transaction() as conn:
+    ...     conn.root()[0]['x'] = 42
+    >>> with db.transaction() as conn:
+    ...     print('%s %s' % (conn.root()[0]['x'], conn.root()[1]['x']))
+    42 1
+    >>> db.close()
+
+    If the snapshot changes, the oids file is ignored and the index
+    is loaded as usual:
+
+    >>> conn = ZODB.connection('snapshot.fs')
+    >>> conn.root()[0]['x'] = 42
+    >>> transaction.commit()
+    >>> conn.db().close()
+    >>> storage = zc.FileStorage.frozen.FrozenFileStorage('snapshot.fs')
+    >>> isinstance(storage._index, zc.FileStorage.frozen.FrozenIndex)
+    False
+    >>> db = ZODB.DB(storage)
+    >>> with db.transaction() as conn:
+    ...     print('%s %s' % (conn.root()[0]['x'], conn.root()[1]['x']))
+    42 1
+    >>> db.close()
+    """
+
+
+def committed_reader():
+    r"""Records committed during a pack are read through a buffer
+
+    The buffer never extends past the committed end, so data appended
+    later is seen once the end is moved:
+
+    >>> with open('data', 'wb') as f:
+    ...     _ = f.write(b'0123456789')
+    >>> reader = zc.FileStorage.CommittedReader('data', 4)
+    >>> reader.read(3) == b'012'
+    True
+    >>> reader.read(3) == b'3'
+    True
+    >>> reader.read(3) == b''
+    True
+    >>> with open('data', 'r+b') as f:
+    ...     _ = f.seek(4)
+    ...     _ = f.write(b'abcd')
+    >>> reader.end = 8
+    >>> reader.read() == b'abcd'
+    True
+    >>> reader.seek(-6, 2)
+    >>> reader.tell(), reader.read(4) == b'23ab'
+    (2, True)
+    >>> reader.close()
+    """
+
+
+def pack_budget():
+    r"""Packs can be spread over several runs with a budget
+
+    >>> import os, transaction
+    >>> from persistent.mapping import PersistentMapping
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(
+    ...         byte_budget=2000, checksums=True, tids=True)))
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i] = PersistentMapping(x=0)
+    ...     transaction.commit()
+    >>> for j in range(3):
+    ...     for i in range(20):
+    ...         conn.root()[i]['x'] += 1
+    ...         transaction.commit()
+    >>> size = db.storage.getSize()
+
+    When a run spends its budget before reaching the pack time, the
+    storage isn't changed, and its progress is saved:
+
+    >>> db.pack()
+    >>> db.storage.getSize() == size
+    True
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'budget' in l])
+    ... # doctest: +ELLIPSIS
+    ['pack budget spent at ... of ..., ... bytes written\n']
+    >>> sorted(f for f in os.listdir('.') if f.startswith('data.fs.pack'))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['data.fs.pack', 'data.fs.pack.checksums', 'data.fs.pack.tids',
+     'data.fs.packlog', 'data.fs.packscript', 'data.fs.packstate',
+     'data.fs.packstate.copied', 'data.fs.packstate.index',
+     'data.fs.packstate.targets']
+
+    Later runs pick up where the last one stopped, packing to the same
+    time, even with transactions committed in between:
+
+    >>> conn.root()[0]['x'] = 42
+    >>> transaction.commit()
+    >>> db.pack()
+
+    They don't scan the whole file again.  They reuse the index and
+    backpointer targets found by the first, only looking for
+    backpointers in transactions committed since:
+
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'from' in l]
+    ...           == ['finding backpointers from %s\n' % size])
+    True
+
+    >>> runs = 2
+    >>> while os.path.exists('data.fs.packstate'):
+    ...     db.pack()
+    ...     runs += 1
+    >>> runs > 2
+    True
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'resuming' in l])
+    ... # doctest: +ELLIPSIS
+    ['resuming pack to ... at ... of ...\n']
+    >>> db.storage.getSize() < size
+    True
+    >>> sorted(f for f in os.listdir('.') if f.startswith('data.fs.pack'))
+    ['data.fs.packlog']
+
+    The result is the same as packing in one go:
+
+    >>> [conn.root()[i]['x'] for i in range(3)]
+    [42, 3, 3]
+    >>> import zc.FileStorage.checksums, zc.FileStorage.tids
+    >>> bad, checked = zc.FileStorage.checksums.scrub('data.fs')
+    >>> bad
+    []
+    >>> index = zc.FileStorage.tids.TidIndex('data.fs.tids')
+    >>> [index[i][0] for i in range(len(index))] == [
+    ...     t.tid for t in db.storage.iterator()]
+    True
+    >>> index.close()
+    >>> db.close()
+
+    Budgets can't be combined with copying in parallel:
+
+    >>> zc.FileStorage.PackProcess(
+    ...     'data.fs', b'\0' * 8, 0, time_budget=60, copy_processes=2)
+    Traceback (most recent call last):
+    ...
+    ValueError: budgets and copy_processes can't be used together
+    """
+
+
+def pack_scheduler():
+    r"""Packs of storages sharing disks can be scheduled
+
+    Packs wait for one of a scheduler's slots:
+
+    >>> import threading, zc.FileStorage.scheduler
+    >>> scheduler = zc.FileStorage.scheduler.Scheduler('sched', slots=1)
+    >>> scheduler.poll_interval = 0.01
+    >>> slot = scheduler.acquire('a.fs', 1000)
+    >>> scheduler.running()
+    1
+
+    >>> slots = []
+    >>> def acquire(path, size, priority=0):
+    ...     slots.append(scheduler.acquire(path, size, priority))
+    >>> threads = [threading.Thread(target=acquire, args=args)
+    ...            for args in [('b.fs', 100), ('c.fs', 10, 1), ('d.fs', 1000)]]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> while len(scheduler.queue()) < 3:
+    ...     time.sleep(0.01)
+
+    Waiting packs run in order of priority, then of expected reclaim:
+
+    >>> [name.rsplit('%2F', 1)[1] for name in scheduler.queue()]
+    ['c.fs', 'd.fs', 'b.fs']
+    >>> slot.release(800)
+    >>> while not slots:
+    ...     time.sleep(0.01)
+    >>> slots[0].name.rsplit('%2F', 1)[1]
+    'c.fs'
+    >>> for i in range(1, 3):
+    ...     slots[i - 1].release()
+    ...     while len(slots) == i:
+    ...         time.sleep(0.01)
+    >>> slots[-1].release()
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> [s.name.rsplit('%2F', 1)[1] for s in slots]
+    ['c.fs', 'd.fs', 'b.fs']
+    >>> scheduler.running(), scheduler.queue()
+    (0, [])
+
+    Entries are named after storages' absolute paths, so different
+    paths don't share entries:
+
+    >>> scheduler.name('/a-b/c.fs') == scheduler.name('/a/b-c.fs')
+    False
+    >>> scheduler.name('/a-b/c.fs')
+    '%2Fa-b%2Fc.fs'
+
+    The expected reclaim is how much a storage has grown since its last
+    pack:
+
+    >>> scheduler.expectedReclaim(slot.name, 1000)
+    200
+
+    With a rate, in MB/s, packs sleep to keep to their share of it:
+
+    >>> scheduler.rate = 1
+    >>> slot = scheduler.acquire('a.fs', 1000)
+    >>> slot.rate == zc.FileStorage.scheduler.MB
+    True
+    >>> start = time.time()
+    >>> for pos in range(0, 1 << 20, 1 << 16):
+    ...     slot.check('copy', pos, 1 << 20)
+    >>> time.time() - start > .8
+    True
+    >>> slot.release()
+
+    Storages are packed with a scheduler by giving its directory:
+
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(
+    ...         scheduler='sched', rate=100, priority=1)))
+    >>> with db.transaction() as conn:
+    ...     conn.root().x = 1
+    >>> with db.transaction() as conn:
+    ...     conn.root().x = 2
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' INFO ')[1] for l in f if 'slot' in l])
+    ['got pack slot 0\n']
+    >>> scheduler.rate = None
+    >>> name = scheduler.name('data.fs')
+    >>> scheduler.expectedReclaim(name, db.storage.getSize())
+    0
+    >>> db.close()
+    """
+
+
+def pack_stream():
+    r"""Packed files can be streamed as they're written
+
+    >>> import os, threading, transaction, zc.FileStorage.stream
+    >>> from persistent.mapping import PersistentMapping
+    >>> received = []
+    >>> thread = threading.Thread(target=lambda: received.append(
+    ...     zc.FileStorage.stream.serve('stream.sock', 'copy.fs')))
+    >>> thread.start()
+    >>> while not os.path.exists('stream.sock'):
+    ...     time.sleep(0.01)
+
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(
+    ...         stream=os.path.abspath('stream.sock'))))
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i] = PersistentMapping(x=0)
+    ...     transaction.commit()
+    >>> for i in range(20):
+    ...     conn.root()[i]['x'] += 1
+    ...     transaction.commit()
+
+    Records committed during the pack are streamed too:
+
+    >>> commit_lock_acquire = db.storage._commit_lock_acquire
+    >>> def _commit_lock_acquire():
+    ...     if (threading.current_thread().name == 'packer'
+    ...         and db.storage._commit_lock_acquire is not commit_lock_acquire):
+    ...         db.storage._commit_lock_acquire = commit_lock_acquire
+    ...         conn2 = db.open()
+    ...         conn2.root()['during'] = 1
+    ...         transaction.commit()
+    ...         conn2.close()
+    ...     commit_lock_acquire()
+    >>> db.storage._commit_lock_acquire = _commit_lock_acquire
+    >>> packer = threading.Thread(target=db.pack, name='packer')
+    >>> packer.start()
+    >>> packer.join()
+    >>> thread.join()
+    >>> conn.sync()
+    >>> conn.root()['during']
+    1
+    >>> received == [db.storage.getSize()]
+    True
+    >>> with open('data.fs', 'rb') as f:
+    ...     with open('copy.fs', 'rb') as copy:
+    ...         f.read(received[0]) == copy.read()
+    True
+    >>> db.close()
+
+    Streams are framed, so they can be sent to pipes too:
+
+    >>> import io
+    >>> with open('copy.fs', 'rb') as f:
+    ...     data = f.read()
+    >>> stream = (zc.FileStorage.stream.magic +
+    ...           zc.FileStorage.stream.frame_header.pack(4, len(data) - 4) +
+    ...           data[4:] +
+    ...           zc.FileStorage.stream.frame_header.pack(len(data), 0))
+    >>> output = io.BytesIO(data[:4])
+    >>> zc.FileStorage.stream.receive(io.BytesIO(stream), output) == len(data)
+    True
+    >>> output.getvalue() == data
+    True
+
+    If no one is reading a named pipe, nothing is streamed to it, and
+    the pack doesn't wait for a reader:
+
+    >>> os.mkfifo('stream.fifo')
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(
+    ...         stream=os.path.abspath('stream.fifo'))))
+    >>> with db.transaction() as conn:
+    ...     conn.root()['during'] = 2
+    >>> db.pack()
+    >>> with open('data.fs.packlog') as f:
+    ...     print([l.split(' WARNING ')[1] for l in f if 'consumer' in l])
+    ... # doctest: +ELLIPSIS
+    ['no consumer reading .../stream.fifo, not streaming\n']
+    >>> db.close()
+
+    If a consumer stops reading, the stream is abandoned after
+    ``send_timeout`` seconds, rather than holding up the pack, or the
+    storage's process, forever:
+
+    >>> import logging, sys
+    >>> handler = logging.StreamHandler(sys.stdout)
+    >>> logger = logging.getLogger('zc.FileStorage.stream')
+    >>> logger.addHandler(handler)
+    >>> logger.propagate = False
+    >>> timeout = zc.FileStorage.stream.send_timeout
+    >>> zc.FileStorage.stream.send_timeout = 0.1
+    >>> reader = os.open('stream.fifo', os.O_RDONLY | os.O_NONBLOCK)
+    >>> with open('big.fs', 'w+b') as output:
+    ...     _ = output.write(b'x' * (1 << 20))
+    ...     streamer = zc.FileStorage.stream.Streamer(output, 'stream.fifo')
+    ...     streamer.close(end=1 << 20)
+    abandoned stream to stream.fifo: nothing read for 0.1 seconds
+    >>> os.close(reader)
+    >>> zc.FileStorage.stream.send_timeout = timeout
+    >>> logger.removeHandler(handler)
+    >>> logger.propagate = True
+    """
+
+
+def pack_warmup():
+    r"""Packed files can be warmed up after packs
+
+    Objects used recently can be captured from a database's caches
+    before packing:
+
+    >>> import logging, threading, transaction, zc.FileStorage.warmup
+    >>> from persistent.mapping import PersistentMapping
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage(
+    ...     'data.fs', packer=zc.FileStorage.Packer(warmup_oids='hot')))
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i] = PersistentMapping(x=0)
+    ...     transaction.commit()
+    >>> for i in range(20):
+    ...     conn.root()[i]['x'] += 1
+    ...     transaction.commit()
+    >>> conn.cacheMinimize()
+    >>> conn.root()[3]['x'], conn.root()[7]['x']
+    (1, 1)
+    >>> zc.FileStorage.warmup.capture(db, 'hot')
+    3
+    >>> hot = zc.FileStorage.warmup.load_oids('hot')
+    >>> hot == [conn.root()[7]._p_oid, ZODB.utils.z64, conn.root()[3]._p_oid]
+    True
+
+    After the pack, the current records of the listed objects are read
+    ahead, in file order, by a background thread:
+
+    >>> messages = []
+    >>> handler = logging.Handler()
+    >>> handler.emit = lambda record: messages.append(record.getMessage())
+    >>> logger = logging.getLogger('zc.FileStorage.warmup')
+    >>> logger.addHandler(handler)
+    >>> logger.setLevel(logging.INFO)
+    >>> db.pack()
+    >>> for thread in threading.enumerate():
+    ...     if thread.name.startswith('warm up'):
+    ...         thread.join()
+    >>> index = db.storage._index
+    >>> regions = zc.FileStorage.warmup.regions(sorted(index[o] for o in hot))
+    >>> messages == ['warmed up 3 records, %s bytes' % sum(
+    ...     end - start for (start, end) in regions)]
+    True
+
+    The records are chosen by the pack subprocess, which passes their
+    positions to the storage's process in a file:
+
+    >>> import os
+    >>> os.path.exists('data.fs.packwarmup')
+    False
+
+    Listed records are all warmed, unless ``warmup`` gives a limit:
+
+    >>> del messages[:]
+    >>> db.storage.packer = zc.FileStorage.Packer(
+    ...     warmup=False, warmup_oids='hot')
+    >>> conn.root()[3]['x'] += 1
+    >>> transaction.commit()
+    >>> db.pack()
+    >>> for thread in threading.enumerate():
+    ...     if thread.name.startswith('warm up'):
+    ...         thread.join()
+    >>> [m.split(',')[0] for m in messages]
+    ['warmed up 3 records']
+    >>> index = db.storage._index
+    >>> len(zc.FileStorage.warmup.positions(index, hot, None))
+    3
+    >>> len(zc.FileStorage.warmup.positions(index, hot, 8192))
+    1
+    >>> logger.removeHandler(handler)
+    >>> logger.setLevel(logging.NOTSET)
+
+    Without a list, the most recently written current records are
+    warmed, up to a limit on the bytes read, and records whose extents
+    overlap are read together:
+
+    >>> positions = zc.FileStorage.warmup.positions(index, limit=3 * 8192)
+    >>> positions == sorted(index.values())[-3:]
+    True
+    >>> positions = zc.FileStorage.warmup.positions(index, hot[:2])
+    >>> positions == sorted(index[oid] for oid in hot[:2])
+    True
+    >>> zc.FileStorage.warmup.regions([4, 100, 9000], 1000)
+    [(4, 1100), (9000, 10000)]
+    >>> with open('data.fs', 'rb') as f:
+    ...     zc.FileStorage.warmup.warm(f, [4, 100, 9000], 1000)
+    (3, 2096)
+
+    >>> db.close()
+    """
+
+
 def hexer(data):
     if data[:2] == b".h":
         return data
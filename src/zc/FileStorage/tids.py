@@ -0,0 +1,167 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Transaction position files
+
+When packing with tids, or making a snapshot with --tids, the position
+of each transaction written is saved in a tids file next to the output
+file.  The file starts with a 4-byte magic number, followed by a
+16-byte entry for each transaction, giving its id and its position, as
+an 8-byte unsigned integer.  Entries are in file order, which is also
+transaction id order, so transactions can be found by id, or time,
+with a binary search.
+
+Transactions committed after the pack aren't covered.  A tids file is
+only used if its last entry matches the file, so positions left
+describing another file, such as a packed file that didn't replace
+the storage's, are ignored.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import os
+
+from ZODB.FileStorage.format import TRANS_HDR_LEN, TxnHeaderFromString
+from ZODB.utils import p64, u64
+
+import ZODB.FileStorage
+
+logger = logging.getLogger(__name__)
+
+magic = b"ZCTI"
+entry_size = 16
+
+
+class TidWriter(object):
+    """Write the ids and positions of transactions to a tids file
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        if append and os.path.exists(path):
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "wb")
+            self.file.write(magic)
+        self.transactions = 0
+
+    def add(self, tid, pos):
+        self.file.write(tid + p64(pos))
+        self.transactions += 1
+
+    def close(self):
+        self.file.close()
+
+
+class TidIndex(object):
+    """Find transactions in a file using its tids file
+
+    Entries are read as needed, so opening a large tids file is cheap.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        if self.file.read(len(magic)) != magic:
+            self.file.close()
+            raise ValueError("%s isn't a tids file" % path)
+        self.file.seek(0, 2)
+        self.size = (self.file.tell() - len(magic)) // entry_size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        """Return the id and position of the `i`th transaction
+        """
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        self.file.seek(len(magic) + i * entry_size)
+        data = self.file.read(entry_size)
+        return data[:8], u64(data[8:])
+
+    def search(self, tid):
+        """Return the index of the first transaction with an id at or
+        after `tid`, or the number of transactions if there isn't one
+        """
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if self[mid][0] < tid:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def find(self, tid):
+        """Return the id and position of the first transaction at or
+        after `tid`, or None
+        """
+        i = self.search(tid)
+        if i < self.size:
+            return self[i]
+        return None
+
+    def before(self, tid):
+        """Return the id and position of the last transaction before
+        `tid`, or None
+        """
+        i = self.search(tid)
+        if i:
+            return self[i - 1]
+        return None
+
+    def matches(self, path):
+        """Return whether the last entry matches the file at `path`
+        """
+        if not self.size:
+            return True
+        tid, pos = self[-1]
+        with open(path, "rb") as f:
+            f.seek(pos)
+            header = f.read(TRANS_HDR_LEN)
+        if len(header) < TRANS_HDR_LEN:
+            return False
+        return TxnHeaderFromString(header).tid == tid
+
+    def close(self):
+        self.file.close()
+
+
+def iterator(path, start=None, stop=None, tids_path=None):
+    """Iterate over the transactions in a file storage file from
+    `start` to `stop`, using the file's tids file to find `start`
+
+    If `start` is after the transactions covered by the tids file,
+    the search for it starts at the last transaction covered.  If the
+    tids file doesn't match the file, it's ignored.
+    """
+    pos = 4
+    if start is not None:
+        tids_path = tids_path or path + ".tids"
+        index = TidIndex(tids_path)
+        try:
+            if index.matches(path):
+                i = index.search(start)
+                if i < len(index):
+                    pos = index[i][1]
+                    start = None
+                elif i:
+                    pos = index[i - 1][1]
+            else:
+                logger.warning("Ignoring %s, which doesn't match %s", tids_path, path)
+        finally:
+            index.close()
+    return ZODB.FileStorage.FileIterator(path, start, stop, pos)
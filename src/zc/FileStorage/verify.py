@@ -0,0 +1,216 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Verification of packed files
+
+Transactions are checked as when building a pack index: time stamps
+must increase, statuses must be valid, data records must point to
+their transactions and fit within them, and redundant transaction
+lengths must match.  In addition, backpointers must point to earlier
+records for the same object, and every index position must point to a
+record for the right object.
+
+A file is divided into chunks at transaction boundaries, which are
+verified by separate processes.
+"""
+
+from __future__ import absolute_import
+
+import io
+import logging
+import multiprocessing
+import os
+import time
+
+from ZODB.FileStorage.format import FileStorageFormatter
+from ZODB.utils import z64
+
+logger = logging.getLogger(__name__)
+
+buffer_size = 1 << 20
+
+
+class Verifier(FileStorageFormatter):
+    def __init__(self, path):
+        self._name = path
+        self._file = io.open(path, "rb", buffer_size)
+        self.ltid = z64
+
+    def close(self):
+        self._file.close()
+
+    def verify(self, start, end, index, ltid=z64, oids=None):
+        """Verify the transactions from `start` to `end`
+
+        `ltid` is the id of the transaction before `start`.  If
+        `oids` is given, the oids of the records verified are added
+        to it.  The number of transactions and records verified, and
+        the number of records that `index` points to are returned.
+        """
+        self.ltid = ltid
+        transactions = records = indexed = 0
+        pos = start
+        while pos < end:
+            th = self._read_txn_header(pos)
+            self.checkTxn(th, pos)
+            tpos = pos
+            tend = tpos + th.tlen
+            if tend + 8 > end:
+                self.fail(pos, "transaction extends past the end: %d", end)
+            pos += th.headerlen()
+            while pos < tend:
+                h = self._read_data_header(pos)
+                if h.back >= pos:
+                    self.fail(pos, "back pointer to a later record: %d", h.back)
+                self.checkData(th, tpos, h, pos)
+                if h.back and self._read_data_header(h.back).oid != h.oid:
+                    self.fail(pos, "back pointer to another object: %d", h.back)
+                if index.get(h.oid) == pos:
+                    indexed += 1
+                if oids is not None:
+                    oids.add(h.oid)
+                records += 1
+                pos += h.recordlen()
+            if pos != tend:
+                self.fail(pos, "data records don't end at the transaction end")
+            tlen = self._read_num(tend)
+            if tlen != th.tlen:
+                self.fail(
+                    tend,
+                    "redundant transaction length does not "
+                    "match initial transaction length: %d != %d",
+                    tlen,
+                    th.tlen,
+                )
+            transactions += 1
+            pos = tend + 8
+
+        return transactions, records, indexed
+
+    def chunks(self, start, end, n):
+        """Divide the transactions from `start` to `end` into about `n`
+        chunks of similar size
+
+        A list of chunk starts and ends and the ids of the transactions
+        before them is returned.
+        """
+        size = max(1, (end - start) // n)
+        chunks = []
+        chunk_start, chunk_ltid = start, self.ltid
+        pos = start
+        tid = chunk_ltid
+        while pos < end:
+            if pos - chunk_start >= size:
+                chunks.append((chunk_start, pos, chunk_ltid))
+                chunk_start, chunk_ltid = pos, tid
+            self._file.seek(pos)
+            tid = self._file.read(8)
+            tlen = self._read_num(pos + 8)
+            if tlen < 8:
+                # Leave it to verify to complain.
+                break
+            pos += tlen + 8
+        chunks.append((chunk_start, end, chunk_ltid))
+        return chunks
+
+    def previous_tid(self, pos):
+        """Return the id of the transaction ending at `pos`
+        """
+        if pos <= 4:
+            return z64
+        tlen = self._read_num(pos - 8)
+        self._file.seek(pos - 8 - tlen)
+        return self._file.read(8)
+
+
+_index = None
+
+
+def _verify(args):
+    path, start, end, ltid = args
+    verifier = Verifier(path)
+    try:
+        return verifier.verify(start, end, _index, ltid)
+    finally:
+        verifier.close()
+
+
+def verify(path, index, start=4, end=None, processes=None):
+    """Verify a file from `start` to `end` using several processes
+
+    `index` must have positions for all of the objects in the file,
+    and only for them.  CorruptedError is raised if there's a problem.
+    """
+    global _index
+    start_time = time.time()
+    if end is None:
+        end = os.path.getsize(path)
+    processes = processes or multiprocessing.cpu_count()
+    verifier = Verifier(path)
+    try:
+        ltid = verifier.previous_tid(start)
+        if processes > 1 and hasattr(os, "fork"):
+            verifier.ltid = ltid
+            chunks = verifier.chunks(start, end, processes * 4)
+        else:
+            chunks = [(start, end, ltid)]
+    finally:
+        verifier.close()
+
+    _index = index
+    try:
+        chunks = [(path,) + chunk for chunk in chunks]
+        if len(chunks) > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_verify, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_verify(chunk) for chunk in chunks]
+    finally:
+        _index = None
+
+    transactions, records, indexed = [sum(r) for r in zip(*results)] or (0, 0, 0)
+    if indexed != len(index):
+        verifier.fail(
+            start,
+            "%d of %d index positions are wrong",
+            len(index) - indexed,
+            len(index),
+        )
+    logger.info(
+        "verified %s transactions, %s records in %.1f seconds",
+        transactions,
+        records,
+        time.time() - start_time,
+    )
+
+
+def verify_tail(path, index, start, end):
+    """Verify the records from `start` to `end`, in this process
+
+    The index is only checked for the objects written from `start`.
+    """
+    verifier = Verifier(path)
+    try:
+        oids = set()
+        transactions, records, indexed = verifier.verify(
+            start, end, index, verifier.previous_tid(start), oids
+        )
+        if indexed != len(oids):
+            verifier.fail(start, "%d index positions are wrong", len(oids) - indexed)
+    finally:
+        verifier.close()
+    return transactions, records
@@ -0,0 +1,196 @@
+##############################################################################
+#
+# Copyright (c) 2005-2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Warming the cache after packs
+
+Packing drops what it reads and writes from the page cache, so the
+packed file is cold when it replaces the storage's file, and loads are
+slow until the cache fills again.  When packing with warmup, regions
+of the packed file holding current records are read ahead, with
+``POSIX_FADV_WILLNEED``, by a background thread once the pack is done.
+
+The records warmed are the current records of hot objects, in the
+order given, if a list of them is given, and otherwise the most
+recently written current records, until a limit on the bytes read is
+reached.  An extent is read from the start of each record, so larger
+records are only partly warmed.  Regions are read in file order, with
+overlapping extents combined.  Records committed during the pack were
+just written by the storage's process and are usually still cached.
+
+The records are chosen by the pack subprocess, which has the packed
+file's index at hand, and their positions are saved in a
+``.packwarmup`` file for the storage's process, so it doesn't walk
+its index.
+
+Hot objects can be listed in a file, an oid per line, as with garbage
+files, and ``capture`` lists the objects in a database's caches.
+"""
+
+from __future__ import absolute_import
+
+import heapq
+import logging
+import os
+import threading
+
+from ZODB.utils import p64, u64
+
+logger = logging.getLogger(__name__)
+
+limit = 256 << 20
+extent = 8192
+
+
+def capture(db, path):
+    """List the objects in a database's caches in a file
+
+    Objects are listed most recently used first.  Ghosts aren't listed.
+    """
+    seen = set()
+    with open(path, "w") as f:
+        for detail in reversed(db.cacheExtremeDetail()):
+            oid = detail["oid"]
+            if detail["state"] is None or oid in seen:
+                continue
+            seen.add(oid)
+            f.write("0x%x\n" % u64(oid))
+    return len(seen)
+
+
+def load_oids(path):
+    """Return the oids listed in a file, in order
+    """
+    oids = []
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(b"#"):
+                continue
+            if line[:2].lower() == b"0x":
+                oids.append(p64(int(line[2:], 16)))
+            else:
+                oids.append(p64(int(line)))
+    return oids
+
+
+def positions(index, oids=None, limit=limit, extent=extent):
+    """Return the positions of the current records to warm, in file order
+
+    If `limit` is None, all of the records of the given oids, or of
+    the index, are warmed.
+    """
+    count = None if limit is None else max(limit // extent, 1)
+    if oids is None:
+        if count is None:
+            found = list(index.itervalues())
+        else:
+            # Recently written records are likeliest to be loaded.
+            found = heapq.nlargest(count, index.itervalues())
+    else:
+        found = []
+        for oid in oids:
+            pos = index.get(oid)
+            if pos is not None:
+                found.append(pos)
+                if len(found) == count:
+                    break
+    found.sort()
+    return found
+
+
+def save_positions(path, positions):
+    """Save positions to warm in a file
+    """
+    with open(path, "wb") as f:
+        f.write(b"".join(p64(pos) for pos in positions))
+
+
+def load_positions(path):
+    """Return the positions saved in a file
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return [u64(data[i : i + 8]) for i in range(0, len(data), 8)]
+
+
+def regions(positions, extent=extent):
+    """Return the regions to read for records at sorted positions
+    """
+    result = []
+    for pos in positions:
+        if result and pos <= result[-1][1]:
+            result[-1][1] = pos + extent
+        else:
+            result.append([pos, pos + extent])
+    return [tuple(region) for region in result]
+
+
+def _advisor(f):
+    # Return a function that reads ahead a region of a file
+    try:
+        from . import _zc_FileStorage_posix_fadvise
+    except ImportError:
+        _zc_FileStorage_posix_fadvise = None
+
+    fd = f.fileno()
+    if _zc_FileStorage_posix_fadvise is not None:
+        return lambda pos, size: _zc_FileStorage_posix_fadvise.advise(
+            fd, pos, size, _zc_FileStorage_posix_fadvise.POSIX_FADV_WILLNEED
+        )
+    if hasattr(os, "posix_fadvise"):
+        return lambda pos, size: os.posix_fadvise(
+            fd, pos, size, os.POSIX_FADV_WILLNEED
+        )
+
+    def read(pos, size):
+        f.seek(pos)
+        f.read(size)
+
+    return read
+
+
+def warm(f, positions, extent=extent):
+    """Read ahead the records at sorted positions in an open file
+
+    The number of records and bytes read ahead are returned.
+    """
+    advise = _advisor(f)
+    size = 0
+    for start, end in regions(positions, extent):
+        advise(start, end - start)
+        size += end - start
+    return len(positions), size
+
+
+def start(path, positions, extent=extent):
+    """Warm the records at sorted positions in a file in the background
+
+    The file is opened before returning, so it's warmed even if it's
+    renamed, as packed files are when they replace the storage's file.
+    The thread doing the work is returned.
+    """
+    f = open(path, "rb")
+
+    def run():
+        try:
+            records, size = warm(f, positions, extent)
+            logger.info("warmed up %s records, %s bytes", records, size)
+        except Exception:
+            logger.exception("warming up %s", path)
+        finally:
+            f.close()
+
+    thread = threading.Thread(target=run, name="warm up %s" % path)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,338 @@
+##############################################################################
+#
+# Copyright (c) 2005 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Long-lived pack workers
+
+Packing in a freshly started Python process means paying for
+interpreter startup and ZODB imports on every pack, which dominates
+when packing many small storages.  A pack worker is started once, with
+its modules already imported, and forks a child for each pack request
+it reads from its standard input.  Log records, progress, errors and
+the resulting index are streamed back over its standard output as a
+sequence of pickled messages:
+
+("log", level, name, message)
+   A log record from the pack.
+
+("progress", phase, pos, end)
+   The pack reached position `pos` of a phase ending at `end`.
+
+("error", exception)
+   The pack failed.
+
+("done", result)
+   The pack finished. The result is None, if there was nothing to
+   pack, or the new index and the position the pack got to.
+
+Pack control commands (see zc.FileStorage.PackControl) given before
+the pack starts are included in the request.  While a pack is running,
+the worker relays ("control", commands) messages from its input to the
+pack until it gets ("control", None), which the parent sends once it
+has the pack's result.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import logging
+import os
+import subprocess
+import sys
+import threading
+import traceback
+
+from zodbpickle import pickle
+
+import zc.FileStorage
+
+
+logger = logging.getLogger(__name__)
+
+worker_script_template = """
+import sys
+
+sys.path[:] = %(syspath)r
+
+import zc.FileStorage.worker
+zc.FileStorage.worker.main()
+"""
+
+
+def send(f, message):
+    # Pickle before writing, so we never write a partial message.
+    f.write(pickle.dumps(message, 1))
+    f.flush()
+
+
+def receive(f):
+    return pickle.Unpickler(f).load()
+
+
+class MessageHandler(logging.Handler):
+    def __init__(self, send):
+        logging.Handler.__init__(self)
+        self.send = send
+
+    def emit(self, record):
+        self.send(("log", record.levelno, record.name, self.format(record)))
+
+
+def run(request, control, send):
+    """Pack as described by a request, sending messages with `send`
+
+    Pack control commands are read from the `control` file descriptor.
+    Returns an exit status.
+    """
+    path = request["path"]
+    handlers = [MessageHandler(send), logging.FileHandler(path + ".packlog")]
+    handlers[1].setFormatter(
+        logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+    )
+    root = logging.getLogger()
+    for handler in handlers:
+        root.addHandler(handler)
+    try:
+        try:
+            packer = zc.FileStorage.PackProcess(
+                path,
+                request["stop"],
+                request["size"],
+                request["blob_dir"],
+                request["sleep"],
+                request["transform"],
+                request["untransform"],
+                **request["options"]
+            )
+            packer.control = zc.FileStorage.PackControl(
+                control, lambda *progress: send(("progress",) + progress)
+            )
+            result = packer.pack()
+            if packer.pack_blobs:
+                # The parent processes the removed-blob list as soon as
+                # it has the result, and forked children exit without
+                # flushing open files, so close it first.
+                packer.blob_removed.close()
+        except Exception as v:
+            logging.exception("packing")
+            try:
+                send(("error", v))
+            except Exception:
+                send(("error", RuntimeError(traceback.format_exc())))
+            return 1
+        send(("done", result))
+        return 0
+    finally:
+        for handler in handlers:
+            root.removeHandler(handler)
+            handler.close()
+
+
+def relay(inp, control):
+    # Relay control commands from the parent until it's done with the
+    # current pack.
+    try:
+        while 1:
+            try:
+                _, command = receive(inp)
+            except EOFError:
+                break
+            if command is None:
+                break
+            try:
+                os.write(control, command)
+            except OSError:
+                pass  # The pack is already done
+    finally:
+        os.close(control)
+
+
+def handle(request, inp, out):
+    """Handle a request in a forked child, relaying its messages to `out`
+    """
+    control_r, control_w = os.pipe()
+    if request.get("commands"):
+        os.write(control_w, request["commands"])
+    relay_thread = threading.Thread(target=relay, args=(inp, control_w))
+    try:
+        if not hasattr(os, "fork"):
+            relay_thread.start()
+            run(request, control_r, lambda message: send(out, message))
+            return
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            # child
+            os.close(r)
+            os.close(control_w)
+            status = 1
+            try:
+                with os.fdopen(w, "wb") as f:
+                    status = run(request, control_r, lambda message: send(f, message))
+            finally:
+                os._exit(status)
+
+        relay_thread.start()
+        os.close(w)
+        finished = False
+        with os.fdopen(r, "rb") as f:
+            while 1:
+                try:
+                    message = receive(f)
+                except EOFError:
+                    break
+                finished = finished or message[0] in ("done", "error")
+                send(out, message)
+
+        _, status = os.waitpid(pid, 0)
+        if not finished:
+            send(
+                out,
+                (
+                    "error",
+                    RuntimeError(
+                        "The pack worker child failed with status %s" % status
+                    ),
+                ),
+            )
+    finally:
+        if relay_thread.ident is None:
+            os.close(control_w)
+        else:
+            relay_thread.join()
+        os.close(control_r)
+
+
+def main():
+    # Messages go over the original standard output.  Anything else
+    # written to standard output, by a stray print, for example, goes
+    # to standard error, so it can't corrupt the message stream.
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    inp = os.fdopen(os.dup(0), "rb")
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    while 1:
+        try:
+            request = receive(inp)
+        except EOFError:
+            break
+        handle(request, inp, out)
+
+
+class PackWorker(object):
+    """Parent-side handle on a worker process
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            (sys.executable, "-c", worker_script_template % dict(syspath=sys.path)),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=-1,
+            close_fds=True,
+        )
+        self.pid = self.process.pid
+        self.healthy = True
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        with self._send_lock:
+            send(self.process.stdin, message)
+
+    def control(self, command):
+        try:
+            self.send(("control", command))
+        except (IOError, OSError):
+            pass
+
+    def pack(self, handle=None, **request):
+        def start(commands):
+            request["commands"] = commands
+            self.send(request)
+
+        try:
+            if handle is None:
+                start(b"")
+            else:
+                handle._attach(self.control, start)
+            try:
+                while 1:
+                    message = receive(self.process.stdout)
+                    if message[0] == "log":
+                        _, level, name, text = message
+                        logger.log(level, "%s: %s", request["path"], text)
+                    elif message[0] == "progress":
+                        if handle is not None:
+                            handle.progress = message[1:]
+                    else:
+                        break
+            finally:
+                if handle is not None:
+                    handle._detach()
+            self.send(("control", None))
+        except (EOFError, IOError, OSError):
+            self.close()
+            raise RuntimeError("The pack worker failed")
+
+        if message[0] == "error":
+            raise message[1]
+        return message[1]
+
+    def close(self):
+        self.healthy = False
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+
+
+_idle = []
+_idle_lock = threading.Lock()
+
+
+def pack(handle=None, **request):
+    """Pack using an idle worker, starting a new one if necessary
+
+    Workers are returned to the idle pool after each pack, so
+    packs of several storages can run at once.  If a PackHandle is
+    given, it's used to control the pack and report progress.
+    """
+    with _idle_lock:
+        worker = _idle.pop() if _idle else None
+    if worker is not None and worker.process.poll() is not None:
+        # It died while idle.
+        worker.close()
+        worker = None
+    if worker is None:
+        worker = PackWorker()
+    try:
+        return worker.pack(handle, **request)
+    finally:
+        if worker.healthy:
+            with _idle_lock:
+                _idle.append(worker)
+
+
+@atexit.register
+def shutdown():
+    """Stop idle workers
+    """
+    with _idle_lock:
+        workers = _idle[:]
+        del _idle[:]
+    for worker in workers:
+        worker.close()